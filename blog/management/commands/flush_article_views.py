@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from blog.utils import flush_article_views
+from config import settings
+
+
+class Command(BaseCommand):
+    help = 'Переносит накопленные в кэше просмотры статей в БД'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.ARTICLE_VIEWS_FLUSH_BATCH_SIZE,
+                            help='Сколько статей обновлять одним запросом')
+
+    def handle(self, *args, **options):
+        flushed = flush_article_views(options['batch_size'])
+        if flushed is None:
+            self.stdout.write('Перенос просмотров уже выполняется')
+        else:
+            self.stdout.write(f'Перенесено просмотров статей: {flushed}')
@@ -0,0 +1,50 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+import config.settings
+from blog.models import Article
+from blog.utils import ARTICLE_VIEWS_DIRTY_KEY, count_article_view, flush_article_views, get_views_key
+
+
+class FlushArticleViewsTestCase(TestCase):
+    """
+    Перенос просмотров читает счётчики только просмотренных статей, а просмотры
+    вычитаются из кэша только после успешного UPDATE
+    """
+
+    def setUp(self):
+        buffered = mock.patch.object(config.settings, 'ARTICLE_VIEWS_BUFFERED', True)
+        buffered.start()
+        self.addCleanup(buffered.stop)
+        cache.clear()
+        self.articles = Article.objects.bulk_create([Article(title=f'Статья {i}', slug=f'article-{i}', content='текст')
+                                                     for i in range(50)])
+        self.viewed = self.articles[:3]
+        for views, article in enumerate(self.viewed, start=1):
+            for _ in range(views):
+                count_article_view(article)
+
+    def get_views(self):
+        return list(Article.objects.filter(pk__in=[article.pk for article in self.viewed])
+                    .order_by('pk').values_list('views', flat=True))
+
+    def test_flush_reads_only_viewed_articles(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(flush_article_views(batch_size=2), 6)
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT')])
+        self.assertEqual(self.get_views(), [1, 2, 3])
+        self.assertEqual([cache.get(get_views_key(article.pk)) for article in self.viewed], [0, 0, 0])
+        self.assertIsNone(cache.get(ARTICLE_VIEWS_DIRTY_KEY))
+        self.assertEqual(flush_article_views(), 0)
+
+    def test_failed_update_keeps_views(self):
+        with mock.patch.object(Article.objects, 'filter', side_effect=RuntimeError('БД недоступна')):
+            with self.assertRaises(RuntimeError):
+                flush_article_views()
+        self.assertEqual([cache.get(get_views_key(article.pk)) for article in self.viewed], [1, 2, 3])
+        self.assertEqual(flush_article_views(), 6)
+        self.assertEqual(self.get_views(), [1, 2, 3])
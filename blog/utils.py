@@ -0,0 +1,137 @@
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+
+from blog.models import Article
+from config import settings
+
+# ключ кэша с ещё не перенесёнными в БД просмотрами статьи
+ARTICLE_VIEWS_KEY = 'article_views:{}'
+# множество id статей, у которых в кэше есть просмотры: перенос читает счётчики только этих статей
+ARTICLE_VIEWS_DIRTY_KEY = 'article_views:dirty'
+# блокировка переноса просмотров в БД: два одновременных запуска перенесли бы одни и те же просмотры дважды
+ARTICLE_VIEWS_FLUSH_LOCK = 'article_views:flush'
+ARTICLE_VIEWS_FLUSH_LOCK_TIMEOUT = 60 * 10
+
+
+def get_views_key(article_id):
+    return ARTICLE_VIEWS_KEY.format(article_id)
+
+
+def get_redis_client():
+    """:return: клиент Redis для записи, если кэш по умолчанию - Redis, иначе None"""
+    default_cache = caches['default']
+    if isinstance(default_cache, RedisCache):
+        return default_cache._cache.get_client(write=True)
+    return None
+
+
+def mark_dirty(article_ids):
+    """
+    Добавляет статьи в множество статей с непереданными просмотрами: в Redis - атомарным SADD, в других кэшах
+    (локальный кэш одного процесса) множество хранится одним значением
+    """
+    client = get_redis_client()
+    if client is not None:
+        client.sadd(cache.make_and_validate_key(ARTICLE_VIEWS_DIRTY_KEY), *article_ids)
+        return
+    dirty = cache.get(ARTICLE_VIEWS_DIRTY_KEY, set())
+    if not dirty.issuperset(article_ids):
+        cache.set(ARTICLE_VIEWS_DIRTY_KEY, dirty | set(article_ids), timeout=None)
+
+
+def pop_dirty():
+    """
+    Забирает из кэша множество статей с непереданными просмотрами. Статьи, просмотренные после этого,
+    снова попадают в множество и переносятся следующим запуском
+    :return: отсортированный список id статей
+    """
+    client = get_redis_client()
+    if client is not None:
+        key = cache.make_and_validate_key(ARTICLE_VIEWS_DIRTY_KEY)
+        size = client.scard(key)
+        return sorted(int(article_id) for article_id in client.spop(key, size)) if size else []
+    dirty = cache.get(ARTICLE_VIEWS_DIRTY_KEY, set())
+    cache.delete(ARTICLE_VIEWS_DIRTY_KEY)
+    return sorted(dirty)
+
+
+def count_article_view(article):
+    """
+    Засчитывает просмотр статьи.
+    При ARTICLE_VIEWS_BUFFERED просмотр прибавляется атомарным INCR к счётчику в кэше, а в БД переносится
+    командой flush_article_views; иначе - сразу одним UPDATE с F(), без сохранения всей строки
+    """
+    if not settings.ARTICLE_VIEWS_BUFFERED:
+        Article.objects.filter(pk=article.pk).update(views=F('views') + 1)
+        article.views += 1
+        return
+    key = get_views_key(article.pk)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # счётчика ещё нет: add не перезапишет счётчик, созданный параллельным запросом
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+    # после INCR: перенос, забравший статью из множества раньше, ещё мог не прочитать этот просмотр
+    mark_dirty([article.pk])
+
+
+def get_pending_views(article_ids):
+    """
+    :return: словарь {id статьи: просмотры в кэше, ещё не перенесённые в БД}
+    """
+    keys = {get_views_key(article_id): article_id for article_id in article_ids}
+    return {keys[key]: count for key, count in cache.get_many(keys).items() if count}
+
+
+def add_pending_views(articles):
+    """
+    Прибавляет к количеству просмотров статей просмотры из кэша, ещё не перенесённые в БД (только для вывода)
+    :return: те же статьи
+    """
+    pending = get_pending_views([article.pk for article in articles])
+    for article in articles:
+        article.views += pending.get(article.pk, 0)
+    return articles
+
+
+def flush_article_views(batch_size=None):
+    """
+    Переносит накопленные в кэше просмотры статей в БД: один UPDATE с F() и CASE на пачку статей.
+    Читаются счётчики только статей из множества ARTICLE_VIEWS_DIRTY_KEY, а не всех статей.
+    Из счётчика вычитается ровно перенесённое значение (DECR) и только после фиксации UPDATE, поэтому
+    просмотры, засчитанные во время переноса, остаются в кэше до следующего запуска, а при ошибке или
+    падении процесса просмотры не теряются (при падении между COMMIT и DECR пачка может быть учтена дважды)
+    :return: количество перенесённых просмотров или None, если перенос уже выполняется другим процессом
+    """
+    if not cache.add(ARTICLE_VIEWS_FLUSH_LOCK, 1, timeout=ARTICLE_VIEWS_FLUSH_LOCK_TIMEOUT):
+        return None
+    try:
+        return _flush_article_views(batch_size or settings.ARTICLE_VIEWS_FLUSH_BATCH_SIZE)
+    finally:
+        cache.delete(ARTICLE_VIEWS_FLUSH_LOCK)
+
+
+def _flush_article_views(batch_size):
+    article_ids = pop_dirty()
+    flushed = 0
+    for start in range(0, len(article_ids), batch_size):
+        pending = get_pending_views(article_ids[start:start + batch_size])
+        if not pending:
+            continue
+        try:
+            with transaction.atomic():
+                Article.objects.filter(pk__in=pending).update(views=F('views') + Case(
+                    *[When(pk=article_id, then=Value(count)) for article_id, count in pending.items()],
+                    default=Value(0), output_field=IntegerField()
+                ))
+        except Exception:
+            # статьи этой и следующих пачек остаются в множестве, их просмотры перенесёт следующий запуск
+            mark_dirty(article_ids[start:])
+            raise
+        for article_id, count in pending.items():
+            cache.decr(get_views_key(article_id), count)
+        flushed += sum(pending.values())
+    return flushed
@@ -1,6 +1,7 @@
 from django.views.generic import ListView, DetailView
 
 from blog.models import Article
+from blog.utils import count_article_view, add_pending_views
 
 
 class ArticleListView(ListView):
@@ -26,6 +27,7 @@ class ArticleDetailView(DetailView):
 
     def get_object(self, queryset=None):
         obj = super().get_object(queryset)
-        obj.views += 1
-        obj.save()
+        count_article_view(obj)
+        # выводим сохранённое в БД количество просмотров вместе с ещё не перенесёнными из кэша и текущим
+        add_pending_views([obj])
         return obj
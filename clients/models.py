@@ -20,3 +20,7 @@ class Client(models.Model):
         verbose_name = 'клиент рассылки'
         verbose_name_plural = 'клиенты рассылки'
         ordering = ('email',)
+        indexes = [
+            models.Index(fields=('email', 'id'), name='client_email_idx'),
+            models.Index(fields=('owner', 'email', 'id'), name='client_owner_email_idx'),
+        ]
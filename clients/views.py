@@ -4,16 +4,17 @@ from django.views.generic import ListView, CreateView, UpdateView, DeleteView
 
 from clients.forms import ClientForm
 from clients.models import Client
+from main.pagination import CursorPaginationMixin
 
 
-class ClientListView(LoginRequiredMixin, ListView):
-    """Представление для просмотра списка получателей рассылок"""
+class ClientListView(LoginRequiredMixin, CursorPaginationMixin, ListView):
+    """Представление для просмотра списка получателей рассылок (курсорная пагинация по email и id)"""
     paginate_by = 50
     model = Client
     extra_context = {'title': 'Подписчики'}
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        queryset = super().get_queryset().select_related('owner')
         if self.request.user.has_perm('clients.view_client'):
             return queryset
         else:
@@ -144,6 +144,49 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # mailing settings -- sending letters to console
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
+# количество писем в одном пакете при отправке рассылки
+EMAIL_BATCH_SIZE = 100
+# по сколько получателей читать из БД при постановке рассылки в очередь
+EMAIL_RECIPIENTS_CHUNK_SIZE = 2000
+# после скольких писем переоткрывать SMTP-соединение (None - не переоткрывать)
+EMAIL_MESSAGES_PER_CONNECTION = 1000
+# максимальное количество пакетов, отправляемых одновременно в асинхронном режиме (getmail --async)
+EMAIL_ASYNC_CONCURRENCY = 100
+# ограничение скорости отправки писем (rate - писем в секунду, None - без ограничения, burst - размер всплеска).
+# При отказе почтового сервиса из-за лимитов скорость умножается на decrease (не ниже min_rate),
+# после каждого успешного письма растёт на increase до исходной, а письмо повторяется через retry_delay секунд
+# (не больше max_deferrals раз, дальше отказы считаются неудачными попытками). Сниженная скорость сохраняется в БД
+# и действует в следующих запусках, если с её изменения прошло не больше remember секунд
+EMAIL_RATE_LIMITS = {
+    'host': {'rate': 20, 'burst': 50},
+    'owner': {'rate': 10, 'burst': 20},
+    'increase': 0.1,
+    'decrease': 0.5,
+    'min_rate': 0.2,
+    'retry_delay': 60,
+    'max_deferrals': 20,
+    'remember': 60 * 60,
+}
+# повторная отправка писем после ошибки: задержка base_delay * 2 ** (попытка - 1) секунд, но не больше max_delay,
+# со случайным разбросом до половины задержки. После max_attempts неудачных попыток письмо считается недоставленным
+EMAIL_RETRY = {
+    'max_attempts': 5,
+    'base_delay': 60,
+    'max_delay': 60 * 60 * 6,
+}
+# лог отправки каждого письма (кроме сводки по рассылке за запуск); логи копятся в памяти и записываются
+# в БД пачками по MAILING_LOG_FLUSH_ROWS записей или раз в MAILING_LOG_FLUSH_INTERVAL секунд
+MAILING_LOG_PER_RECIPIENT = True
+MAILING_LOG_FLUSH_ROWS = 1000
+MAILING_LOG_FLUSH_INTERVAL = 5
+# сколько дней хранить логи отправки (manage.py prune_mailing_logs удаляет более старые пачками
+# по MAILING_LOG_PRUNE_BATCH_SIZE записей)
+MAILING_LOG_RETENTION_DAYS = 180
+MAILING_LOG_PRUNE_BATCH_SIZE = 10000
+# через сколько секунд письмо, взятое в работу, но не отправленное (например, процесс упал), снова можно взять из очереди
+OUTBOX_CLAIM_TIMEOUT = 60 * 30
+# сколько дней хранить в очереди отправленные и недоставленные письма (manage.py prune_outbox)
+OUTBOX_RETENTION_DAYS = 30
 
 AUTH_USER_MODEL = 'users.User'
 
@@ -151,8 +194,36 @@ LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 LOGIN_URL = '/users/'
 
+# пропущенные даты отправки (например, сервер был выключен): 'send' - отправить рассылку один раз и перейти
+# к расписанию, 'skip' - не отправлять, перейти к ближайшей дате по расписанию
+MAILING_CATCH_UP_POLICY = 'send'
+
+# убирать дубли адресов не только внутри рассылки, но и между всеми рассылками одного запуска getmail
+MAILING_DEDUPE_PER_RUN = False
+
+# через сколько секунд планировщик рассылок (manage.py mailing_scheduler) перечитывает даты отправки из БД
+MAILING_SCHEDULER_REFRESH_INTERVAL = 60 * 5
+
+# имя узла для getmail --shard (по умолчанию имя хоста) и через сколько секунд без запусков узел
+# перестаёт учитываться при проверке пересечения шардов
+MAILING_NODE_NAME = os.getenv('MAILING_NODE_NAME')
+MAILING_NODE_TTL = 60 * 60
+
+# сколько секунд getmail ждёт окончания предыдущего запуска (0 - сразу завершиться) и через сколько секунд
+# блокировку запуска упавшего процесса можно забрать (только для БД без рекомендательных блокировок PostgreSQL)
+MAILING_RUN_LOCK_WAIT = 0
+MAILING_RUN_LOCK_TTL = 60 * 60 * 2
+
+# сбор метрик отправки (страница /mailing/metrics/ в формате Prometheus); если задан MAILING_METRICS_TOKEN,
+# страница доступна по заголовку Authorization: Bearer <токен>, иначе только сотрудникам
+MAILING_METRICS_ENABLED = os.getenv('MAILING_METRICS_ENABLED') == 'True'
+MAILING_METRICS_TOKEN = os.getenv('MAILING_METRICS_TOKEN')
+
 CRONJOBS = [
-    ('*/5 * * * *', 'django.core.management.call_command', ['getmail'])
+    ('*/5 * * * *', 'django.core.management.call_command', ['getmail']),
+    ('30 3 * * *', 'django.core.management.call_command', ['prune_mailing_logs']),
+    ('45 3 * * *', 'django.core.management.call_command', ['prune_outbox']),
+    ('* * * * *', 'django.core.management.call_command', ['flush_article_views']),
 ]
 
 # enable cache
@@ -167,3 +238,25 @@ if CACHE_ENABLED:
     }
 
 CACHE_TIMEOUT = 60 * 5
+
+# просмотры статей копятся в кэше и переносятся в БД командой flush_article_views (см. CRONJOBS).
+# Счётчики должны быть общими для всех процессов (Redis), поэтому по умолчанию буфер включён вместе с кэшем;
+# без него каждый просмотр сразу записывается в БД одним UPDATE
+ARTICLE_VIEWS_BUFFERED = os.getenv('ARTICLE_VIEWS_BUFFERED', str(CACHE_ENABLED)) == 'True'
+ARTICLE_VIEWS_FLUSH_BATCH_SIZE = 500
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'mailing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
@@ -5,3 +5,6 @@ class MailingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mailing'
     verbose_name = 'Рассылка'
+
+    def ready(self):
+        import mailing.signals  # noqa
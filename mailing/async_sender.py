@@ -0,0 +1,110 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.core.mail import get_connection
+from django.db import connection
+
+import config.settings
+from mailing.outbox import claim_batch, complete_batch, send_batch, is_batch_aborted
+from mailing.ratelimit import RateLimiter
+from mailing.utils import MailSender
+
+
+def close_connection():
+    """Закрывает соединение с БД текущего потока (connection.close нужно вызвать в потоке sync_to_async)"""
+    connection.close()
+
+
+class AsyncMailSender:
+    """
+    Асинхронная отправка писем из очереди: одновременно в работе до concurrency пакетов.
+    Открытые SMTP-соединения к почтовому серверу не закрываются после пакета,
+    а возвращаются в пул и переиспользуются следующими пакетами.
+    Это пул потоков под управлением asyncio, а не асинхронный ввод-вывод: asyncio только планирует пакеты
+    и ограничивает их число, а каждый пакет целиком отправляется блокирующими вызовами smtplib (send_batch)
+    в отдельном потоке пула размером concurrency (по умолчанию EMAIL_ASYNC_CONCURRENCY = 100 потоков),
+    запросы к БД выполняются через sync_to_async
+    """
+
+    def __init__(self, concurrency=None, connection_factory=get_connection, limiter=None):
+        """
+        :param concurrency: максимальное количество одновременно отправляемых пакетов
+        :param connection_factory: функция, возвращающая новое соединение с почтовым сервером
+        (например, соединение с локальным тестовым SMTP-сервером)
+        :param limiter: RateLimiter, по умолчанию создаётся новый
+        """
+        self.concurrency = concurrency or config.settings.EMAIL_ASYNC_CONCURRENCY
+        self.connection_factory = connection_factory
+        self.idle_senders = []
+        self.senders = []
+        # пакет прерван ошибкой соединения с почтовым сервером: новые пакеты из очереди не забираются
+        self.aborted = False
+        self.limiter = limiter or RateLimiter()
+
+    def acquire_sender(self):
+        """Берёт свободное соединение из пула или открывает новое"""
+        if self.idle_senders:
+            return self.idle_senders.pop()
+        sender = MailSender(connection=self.connection_factory())
+        self.senders.append(sender)
+        return sender
+
+    async def send_batch(self, semaphore, executor, rows, report):
+        """Отправка одного пакета писем через свободное соединение из пула и запись результата"""
+        try:
+            sender = self.acquire_sender()
+            try:
+                sent, failed, elapsed = await asyncio.get_running_loop().run_in_executor(
+                    executor, send_batch, sender, rows, self.limiter
+                )
+            finally:
+                self.idle_senders.append(sender)
+            await sync_to_async(complete_batch)(sent, failed, report.log_writer)
+            report.add(sent, failed, elapsed)
+            self.aborted = self.aborted or is_batch_aborted(failed)
+        finally:
+            semaphore.release()
+
+    async def dispatch(self, report, batch_size=None):
+        """
+        Отправка писем из очереди, пока она не опустеет или не возникнет ошибка соединения с почтовым сервером,
+        с ограничением числа одновременных отправок.
+        Работа с БД выполняется через sync_to_async, его соединение с БД закрывается по окончании
+        :param report: DispatchReport для сводки по рассылкам
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                while True:
+                    await semaphore.acquire()
+                    rows = [] if self.aborted else await sync_to_async(claim_batch)(batch_size)
+                    if not rows:
+                        semaphore.release()
+                        break
+                    tasks.append(asyncio.create_task(self.send_batch(semaphore, executor, rows, report)))
+                await asyncio.gather(*tasks)
+        finally:
+            await sync_to_async(close_connection)()
+
+    def close(self):
+        for sender in self.senders:
+            sender.connection.close()
+        self.idle_senders.clear()
+        self.senders.clear()
+
+
+def send_mail_async(report, concurrency=None, connection_factory=get_connection, limiter=None):
+    """
+    Функция асинхронной отправки писем из очереди
+    :param report: DispatchReport для сводки по рассылкам
+    :param concurrency: максимальное количество одновременно отправляемых пакетов
+    :param connection_factory: функция, возвращающая новое соединение с почтовым сервером
+    :param limiter: RateLimiter, по умолчанию создаётся новый
+    """
+    sender = AsyncMailSender(concurrency, connection_factory, limiter)
+    try:
+        asyncio.run(sender.dispatch(report))
+    finally:
+        sender.close()
@@ -0,0 +1,54 @@
+import hashlib
+import heapq
+from array import array
+from bisect import bisect_left
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+class EmailSet:
+    """
+    Компактное множество адресов для удаления дублей получателей.
+    Хранит не сами адреса, а их 64-битные хеши: новые - в обычном множестве, которое при заполнении
+    сливается в отсортированный массив (8 байт на адрес), поиск по массиву - бинарный.
+    Вероятность ложного совпадения хешей на миллионах адресов пренебрежимо мала
+    """
+
+    def __init__(self, merge_size=100_000):
+        self.merged = array('Q')
+        self.recent = set()
+        self.merge_size = merge_size
+
+    def __len__(self):
+        return len(self.merged) + len(self.recent)
+
+    @staticmethod
+    def get_hash(email):
+        digest = hashlib.blake2b(normalize_email(email).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def __contains__(self, email):
+        return self.contains_hash(self.get_hash(email))
+
+    def contains_hash(self, value):
+        if value in self.recent:
+            return True
+        i = bisect_left(self.merged, value)
+        return i < len(self.merged) and self.merged[i] == value
+
+    def add(self, email):
+        """
+        Добавляет адрес в множество
+        :return: True, если адреса ещё не было
+        """
+        value = self.get_hash(email)
+        if self.contains_hash(value):
+            return False
+        self.recent.add(value)
+        if len(self.recent) >= self.merge_size:
+            # слияние сразу в новый массив: без промежуточного списка из всех хешей
+            self.merged = array('Q', heapq.merge(self.merged, sorted(self.recent)))
+            self.recent.clear()
+        return True
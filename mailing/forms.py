@@ -2,6 +2,7 @@ from django import forms
 
 from clients.models import Client
 from mailing.models import MailingMessage, MailingSettings
+from mailing.utils import PersonalizationError, validate_body
 
 
 class StyleFormMixin:
@@ -25,6 +26,9 @@ class MailingForm(StyleFormMixin, forms.ModelForm):
     class Meta:
         model = MailingMessage
         fields = ['subject', 'body', 'recipient', ]
+        help_texts = {
+            'body': 'Можно обращаться к получателю: {{ client.name }}, {{ client.email }}, {{ client.comment }}',
+        }
 
     def __init__(self, *args, **kwargs):
         user = kwargs.pop('user')
@@ -34,6 +38,15 @@ class MailingForm(StyleFormMixin, forms.ModelForm):
         else:
             self.fields['recipient'].queryset = Client.objects.filter(owner=user)
 
+    def clean_body(self):
+        """Проверка, что теги персонализации в тексте рассылки записаны без ошибок и заполняются данными получателя"""
+        body = self.cleaned_data.get('body')
+        try:
+            validate_body(body)
+        except PersonalizationError as e:
+            raise forms.ValidationError(str(e))
+        return body
+
 
 class MailingSettingsForm(StyleFormMixin, forms.ModelForm):
     """Дополнительная форма для рассылки: время начала, время окончания, периодичность"""
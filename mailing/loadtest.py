@@ -0,0 +1,359 @@
+import datetime
+import random
+import resource
+import threading
+import time
+import tracemalloc
+
+from django.contrib.auth.hashers import make_password
+from django.core.mail import EmailMessage
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import Q
+from django.test.utils import override_settings
+from django.utils import timezone
+
+import config.settings
+from clients.models import Client
+from mailing.models import MailingMessage, MailingSettings, MailingOutbox
+from mailing.outbox import DispatchReport, drain_outbox, enqueue_mailing
+from mailing.ratelimit import RateLimiter
+from mailing.utils import MailSender, PreparedEmailMessage, get_message_template
+from users.models import User
+
+# домен адресов тестовых пользователей и клиентов: по нему находятся данные нагрузочного теста
+LOAD_EMAIL_DOMAIN = 'load.test'
+
+EMAIL_BACKENDS = {
+    'locmem': 'django.core.mail.backends.locmem.EmailBackend',
+    'file': 'django.core.mail.backends.filebased.EmailBackend',
+    'dummy': 'django.core.mail.backends.dummy.EmailBackend',
+}
+
+# размер пакета bulk_create при заполнении БД
+SEED_BATCH_SIZE = 1000
+
+
+def seed_load(users, clients_per_user, mailings_per_user, seed=None, stdout=None):
+    """
+    Создаёт тестовые данные для нагрузочного теста: пользователей, их клиентов и рассылки
+    со случайными настройками, отправка по которым приходится на текущую дату.
+    Все записи создаются через bulk_create
+    :param seed: начальное значение генератора случайных чисел для повторяемых данных
+    :return: количество созданных пользователей, клиентов и рассылок
+    """
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    # все тестовые пользователи без пароля, хэш считаем один раз
+    password = make_password(None)
+    first_number = User.objects.filter(email__endswith=f'@{LOAD_EMAIL_DOMAIN}').count()
+
+    with transaction.atomic():
+        owners = User.objects.bulk_create(
+            [User(email=f'user{first_number + i}@{LOAD_EMAIL_DOMAIN}', password=password, is_active=True)
+             for i in range(users)],
+            batch_size=SEED_BATCH_SIZE
+        )
+        clients_count = mailings_count = 0
+        for owner in owners:
+            clients = Client.objects.bulk_create(
+                [Client(email=f'client{i}.{owner.pk}@{LOAD_EMAIL_DOMAIN}', name=f'Клиент {i}', owner=owner)
+                 for i in range(clients_per_user)],
+                batch_size=SEED_BATCH_SIZE
+            )
+            mailings = MailingMessage.objects.bulk_create(
+                [MailingMessage(subject=f'Рассылка {i}', body='Здравствуйте, {{ client.name }}!', owner=owner)
+                 for i in range(mailings_per_user)],
+                batch_size=SEED_BATCH_SIZE
+            )
+            recipients = []
+            for mailing in mailings:
+                count = rng.randint(1, len(clients)) if clients else 0
+                for client in rng.sample(clients, count):
+                    recipients.append(MailingMessage.recipient.through(mailingmessage_id=mailing.pk,
+                                                                       client_id=client.pk))
+            MailingMessage.recipient.through.objects.bulk_create(recipients, batch_size=SEED_BATCH_SIZE)
+            MailingSettings.objects.bulk_create(
+                [get_random_settings(mailing, today, rng) for mailing in mailings],
+                batch_size=SEED_BATCH_SIZE
+            )
+            clients_count += len(clients)
+            mailings_count += len(mailings)
+            if stdout:
+                stdout.write(f'{owner.email}: клиентов {len(clients)}, рассылок {len(mailings)}')
+    return len(owners), clients_count, mailings_count
+
+
+def get_random_settings(mailing, today, rng):
+    """Настройки рассылки со случайной периодичностью, начатой не раньше недели назад и действующей сегодня"""
+    start = today - datetime.timedelta(days=rng.randint(0, 7))
+    return MailingSettings(
+        message=mailing,
+        mailing_start=start,
+        mailing_end=today + datetime.timedelta(days=rng.randint(7, 90)),
+        mailing_period=rng.choice(MailingSettings.FREQUENCY.values + [None]),
+    )
+
+
+class RealMailError(Exception):
+    """В БД есть настоящие письма, которые нагрузочный тест отправил бы локальным почтовым бэкендом"""
+
+
+def get_load_settings():
+    return MailingSettings.objects.filter(message__owner__email__endswith=f'@{LOAD_EMAIL_DOMAIN}')
+
+
+def check_no_real_mail(current_date):
+    """
+    Проверяет, что нагрузочный тест не затронет настоящие рассылки: getmail и разбор очереди отправляют всё,
+    что готово к отправке, поэтому настоящие письма ушли бы в локальный бэкенд и были бы отмечены отправленными,
+    а даты следующей отправки их рассылок - сдвинуты
+    :raise RealMailError: если есть рассылки не из теста, отправка по которым назначена на current_date или раньше,
+    или их письма ждут отправки в очереди
+    """
+    load_owner = Q(message__owner__email__endswith=f'@{LOAD_EMAIL_DOMAIN}')
+    due = (MailingSettings.objects.exclude(load_owner)
+           .filter(message__is_published=True, mailing_start__lte=current_date)
+           .exclude(mailing_status=MailingSettings.STATUS.COMPLETED)
+           .filter(Q(next_sending_date__isnull=True) | Q(next_sending_date__lte=current_date))
+           .count())
+    queued = (MailingOutbox.objects.exclude(mailing__owner__email__endswith=f'@{LOAD_EMAIL_DOMAIN}')
+              .filter(status__in=(MailingOutbox.STATUS.PENDING, MailingOutbox.STATUS.FAILED,
+                                  MailingOutbox.STATUS.SENDING))
+              .count())
+    if due or queued:
+        raise RealMailError(f'В БД есть настоящие рассылки к отправке ({due}) или письма в очереди ({queued}). '
+                            f'Нагрузочный тест отправил бы их; запускайте его на отдельной БД')
+
+
+def reset_load_schedule(current_date):
+    """
+    Назначает все тестовые рассылки на текущую дату и убирает их письма за эту дату из очереди,
+    чтобы каждый запуск теста отправлял один и тот же объём писем
+    :return: количество тестовых рассылок
+    """
+    settings = get_load_settings()
+    MailingOutbox.objects.filter(mailing__setting__in=settings, send_date=current_date).delete()
+    settings.update(mailing_status=MailingSettings.STATUS.CREATED, next_sending_date=current_date)
+    return settings.values('message').distinct().count()
+
+
+class QueryCounter:
+    """
+    Счётчик запросов к БД во всех соединениях, в том числе открытых потоками отправки.
+    Работает через execute_wrapper, поэтому не требует DEBUG
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connection_created.connect(self.install)
+        self.install(connection=connection)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection_created.disconnect(self.install)
+        if self in connection.execute_wrappers:
+            connection.execute_wrappers.remove(self)
+
+
+def get_peak_rss_mb():
+    """Пиковый объём памяти процесса в МБ (ru_maxrss в Linux - в КБ)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_unlimited_rate_limits():
+    """EMAIL_RATE_LIMITS без ограничения скорости на почтовый сервер и владельца рассылок"""
+    return {**config.settings.EMAIL_RATE_LIMITS, 'host': {'rate': None}, 'owner': {'rate': None}}
+
+
+def run_benchmark(backend='locmem', file_path=None, rate_limits=False, **getmail_options):
+    """
+    Запускает полный цикл отправки (getmail) по тестовым рассылкам с локальным почтовым бэкендом
+    :param backend: 'locmem' - письма в памяти, 'file' - в файлы каталога file_path
+    :param rate_limits: соблюдать EMAIL_RATE_LIMITS; по умолчанию лимиты отключаются,
+    чтобы измерять скорость самой отправки, а не заданные лимиты
+    :param getmail_options: опции getmail (workers, use_async, concurrency)
+    :return: словарь с результатами для сохранения в JSON
+    :raise RealMailError: если в БД есть настоящие письма к отправке (check_no_real_mail)
+    """
+    today = datetime.date.today()
+    check_no_real_mail(today)
+    mailings = reset_load_schedule(today)
+    email_settings = {'EMAIL_BACKEND': EMAIL_BACKENDS[backend]}
+    if file_path:
+        email_settings['EMAIL_FILE_PATH'] = file_path
+
+    limits = config.settings.EMAIL_RATE_LIMITS
+    if not rate_limits:
+        config.settings.EMAIL_RATE_LIMITS = get_unlimited_rate_limits()
+    started_at = timezone.now()
+    try:
+        with override_settings(**email_settings), QueryCounter() as queries:
+            started = time.monotonic()
+            call_command('getmail', **getmail_options)
+            elapsed = time.monotonic() - started
+    finally:
+        config.settings.EMAIL_RATE_LIMITS = limits
+
+    messages = MailingOutbox.objects.filter(status=MailingOutbox.STATUS.SENT, sent_at__gte=started_at).count()
+    return {
+        'date': started_at.isoformat(),
+        'db': connection.vendor,
+        'backend': backend,
+        'options': getmail_options,
+        'rate_limits': rate_limits,
+        'mailings': mailings,
+        'messages': messages,
+        'seconds': round(elapsed, 3),
+        'msgs_per_sec': round(messages / elapsed, 1) if elapsed else None,
+        'queries': queries.count,
+        'queries_per_mailing': round(queries.count / mailings, 2) if mailings else None,
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+    }
+
+
+def seed_recipients(clients, stdout=None):
+    """
+    Создаёт тестового пользователя с рассылкой на clients получателей для замера памяти отправки.
+    Клиенты и получатели рассылки создаются частями по SEED_BATCH_SIZE, поэтому заполнение не держит в памяти
+    весь список. Если рассылка на столько получателей уже создана, используется она
+    :return: рассылка
+    """
+    email = f'recipients{clients}@{LOAD_EMAIL_DOMAIN}'
+    mailing = MailingMessage.objects.filter(owner__email=email).first()
+    if mailing is not None:
+        return mailing
+    with transaction.atomic():
+        owner = User.objects.create(email=email, password=make_password(None), is_active=True)
+        mailing = MailingMessage.objects.create(subject='Рассылка на всех клиентов',
+                                                body='Здравствуйте, {{ client.name }}!', owner=owner)
+        for start in range(0, clients, SEED_BATCH_SIZE):
+            batch = Client.objects.bulk_create(
+                [Client(email=f'client{i}.{owner.pk}@{LOAD_EMAIL_DOMAIN}', name=f'Клиент {i}', owner=owner)
+                 for i in range(start, min(start + SEED_BATCH_SIZE, clients))]
+            )
+            MailingMessage.recipient.through.objects.bulk_create(
+                [MailingMessage.recipient.through(mailingmessage_id=mailing.pk, client_id=client.pk)
+                 for client in batch]
+            )
+            if stdout and (start // SEED_BATCH_SIZE) % 100 == 0:
+                stdout.write(f'Создано клиентов: {start + len(batch)} из {clients}')
+    return mailing
+
+
+def measure_memory(func, *args):
+    """
+    Выполняет func, отслеживая выделения памяти Python (tracemalloc)
+    :return: результат func и пиковый объём памяти, выделенной за время выполнения, в МБ
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, round(peak / 2 ** 20, 1)
+
+
+def run_recipients_benchmark(clients, backend='dummy', batch_size=None, stdout=None):
+    """
+    Замер памяти отправки рассылки на clients получателей (manage.py benchmark_recipients):
+    постановка писем в очередь и отправка из очереди без ограничения скорости. Пиковая память каждого этапа
+    не должна зависеть от количества получателей
+    :param backend: почтовый бэкенд из EMAIL_BACKENDS; 'dummy' не хранит письма, поэтому не влияет на замер
+    :return: словарь с результатами для сохранения в JSON
+    :raise RealMailError: если в БД есть настоящие письма к отправке (check_no_real_mail)
+    """
+    today = datetime.date.today()
+    check_no_real_mail(today)
+    mailing = seed_recipients(clients, stdout)
+    MailingOutbox.objects.filter(mailing=mailing).delete()
+
+    _, enqueue_peak = measure_memory(enqueue_mailing, mailing, today)
+    report = DispatchReport()
+    with override_settings(EMAIL_BACKEND=EMAIL_BACKENDS[backend]), MailSender() as sender:
+        started = time.monotonic()
+        _, send_peak = measure_memory(drain_outbox, sender, report, RateLimiter(get_unlimited_rate_limits()),
+                                      batch_size)
+        elapsed = time.monotonic() - started
+
+    messages = MailingOutbox.objects.filter(mailing=mailing, status=MailingOutbox.STATUS.SENT).count()
+    return {
+        'date': timezone.now().isoformat(),
+        'db': connection.vendor,
+        'backend': backend,
+        'clients': clients,
+        'messages': messages,
+        'send_seconds': round(elapsed, 3),
+        'enqueue_peak_mb': enqueue_peak,
+        'send_peak_mb': send_peak,
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+    }
+
+
+def run_mime_benchmark(messages=3000, body_kb=100):
+    """
+    Замер сборки писем рассылки без БД и почтового сервера (manage.py benchmark_getmail --mime):
+    письмо собирается и кодируется в MIME заново для каждого получателя (EmailMessage)
+    или берётся готовым из MessageTemplate (PreparedEmailMessage), как при отправке рассылки.
+    В обоих случаях письмо сериализуется с разделителем строк CRLF, как для SMTP
+    :param messages: количество писем
+    :param body_kb: размер текста письма в КБ (кириллица, кодируется quoted-printable)
+    :return: словарь с результатами для сохранения в JSON
+    """
+    line = 'Здравствуйте! Это текст тестовой рассылки для замера скорости сборки писем.\n'
+    body = line * (body_kb * 1024 // len(line.encode()) + 1)
+    subject = 'Тестовая рассылка'
+    from_email = config.settings.EMAIL_HOST_USER or f'sender@{LOAD_EMAIL_DOMAIN}'
+    emails = [f'client{i}@{LOAD_EMAIL_DOMAIN}' for i in range(messages)]
+
+    def build_each():
+        for email in emails:
+            EmailMessage(subject=subject, body=body, from_email=from_email, to=[email]).message().as_bytes(
+                linesep='\r\n')
+
+    def build_prepared():
+        # шаблон собирается в замере, как при первом письме рассылки
+        get_message_template.cache_clear()
+        for email in emails:
+            template = get_message_template(None, subject, body, from_email)
+            PreparedEmailMessage(template, email).message().as_bytes(linesep='\r\n')
+
+    result = {'messages': messages, 'body_kb': body_kb}
+    for key, build in (('per_message', build_each), ('prepared', build_prepared)):
+        started = time.monotonic()
+        build()
+        elapsed = time.monotonic() - started
+        result[f'{key}_msgs_per_sec'] = round(messages / elapsed, 1) if elapsed else None
+    return result
+
+
+def compare_results(result, baseline, tolerance=0.1):
+    """
+    Сравнивает результат теста с сохранённым ранее
+    :param tolerance: допустимое ухудшение в долях
+    :return: список сообщений об ухудшении показателей
+    """
+    regressions = []
+    for key, higher_is_better in (('msgs_per_sec', True), ('queries_per_mailing', False), ('peak_rss_mb', False),
+                                  ('prepared_msgs_per_sec', True)):
+        old, new = baseline.get(key), result.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f'{key}: {old} -> {new} ({change:+.0%})')
+    return regressions
@@ -0,0 +1,108 @@
+import datetime
+import hashlib
+import threading
+import time
+import uuid
+
+from django.db import connection, IntegrityError
+from django.utils import timezone
+
+from config import settings
+from mailing.models import MailingRunLock
+
+
+class RunLock:
+    """
+    Блокировка, не дающая двум запускам отправки работать одновременно.
+    В PostgreSQL используется сессионная рекомендательная блокировка (pg_try_advisory_lock), которая снимается
+    сама при обрыве соединения. В других БД - строка в таблице MailingRunLock, которую после падения процесса
+    можно забрать через MAILING_RUN_LOCK_TTL секунд. Пока блокировка удерживается, фоновый поток продлевает
+    срок строки каждые MAILING_RUN_LOCK_TTL / 3 секунд, поэтому запуск дольше MAILING_RUN_LOCK_TTL
+    не теряет блокировку
+    """
+    # как часто повторять попытку взять занятую блокировку
+    poll_interval = 0.5
+
+    def __init__(self, name):
+        self.name = name
+        self.token = uuid.uuid4().hex
+        self.acquired_at = None
+        self.wait_time = 0
+        self.released = threading.Event()
+        self.heartbeat = None
+
+    @property
+    def key(self):
+        """Ключ рекомендательной блокировки PostgreSQL: знаковое 64-битное число из имени"""
+        digest = hashlib.blake2b(self.name.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    def try_acquire(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_try_advisory_lock(%s)', [self.key])
+                return cursor.fetchone()[0]
+
+        now = timezone.now()
+        expires_at = now + datetime.timedelta(seconds=settings.MAILING_RUN_LOCK_TTL)
+        try:
+            MailingRunLock.objects.create(name=self.name, token=self.token, expires_at=expires_at)
+            return True
+        except IntegrityError:
+            # блокировка осталась от упавшего процесса - забираем её, если срок истёк
+            return bool(MailingRunLock.objects.filter(name=self.name, expires_at__lt=now)
+                        .update(token=self.token, expires_at=expires_at))
+
+    def acquire(self, timeout=0):
+        """
+        Берёт блокировку, при необходимости ожидая её освобождения
+        :param timeout: сколько секунд ждать, если блокировка занята (0 - не ждать)
+        :return: True, если блокировка получена
+        """
+        started_at = time.monotonic()
+        acquired = self.try_acquire()
+        while not acquired and time.monotonic() - started_at < timeout:
+            time.sleep(self.poll_interval)
+            acquired = self.try_acquire()
+        self.wait_time = time.monotonic() - started_at
+        if acquired:
+            self.acquired_at = time.monotonic()
+            if connection.vendor != 'postgresql':
+                self.released.clear()
+                self.heartbeat = threading.Thread(target=self.keep_alive, daemon=True)
+                self.heartbeat.start()
+        return acquired
+
+    def refresh(self):
+        """
+        Продлевает срок строки блокировки на MAILING_RUN_LOCK_TTL секунд от текущего момента
+        :return: True, если блокировка всё ещё принадлежит этому запуску
+        """
+        expires_at = timezone.now() + datetime.timedelta(seconds=settings.MAILING_RUN_LOCK_TTL)
+        return bool(MailingRunLock.objects.filter(name=self.name, token=self.token).update(expires_at=expires_at))
+
+    def keep_alive(self):
+        """Фоновый поток: продлевает блокировку, пока она не снята, и закрывает своё соединение с БД"""
+        try:
+            while not self.released.wait(settings.MAILING_RUN_LOCK_TTL / 3):
+                self.refresh()
+        finally:
+            connection.close()
+
+    def release(self):
+        """
+        Снимает блокировку
+        :return: сколько секунд блокировка удерживалась
+        """
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)', [self.key])
+        else:
+            if self.heartbeat:
+                self.released.set()
+                self.heartbeat.join()
+                self.heartbeat = None
+            MailingRunLock.objects.filter(name=self.name, token=self.token).delete()
+        held_time = time.monotonic() - self.acquired_at
+        self.acquired_at = None
+        return held_time
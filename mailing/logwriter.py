@@ -0,0 +1,67 @@
+import atexit
+import threading
+import time
+
+from django.db import transaction
+
+from config import settings
+from mailing.models import MailingLog
+from mailing.stats import add_to_daily_stats
+
+
+class BufferedLogWriter:
+    """
+    Буфер логов отправки: записи копятся в памяти и сохраняются одним bulk_create,
+    когда их набирается MAILING_LOG_FLUSH_ROWS или с прошлой записи прошло MAILING_LOG_FLUSH_INTERVAL секунд.
+    Оставшиеся записи сохраняются при выходе из блока with (в том числе по исключению)
+    и при завершении процесса. Вместе с логами в той же транзакции обновляется статистика по дням.
+    Один буфер можно использовать из нескольких потоков
+    """
+
+    def __init__(self, flush_rows=None, flush_interval=None):
+        self.flush_rows = flush_rows or settings.MAILING_LOG_FLUSH_ROWS
+        self.flush_interval = flush_interval or settings.MAILING_LOG_FLUSH_INTERVAL
+        self.logs = []
+        self.lock = threading.Lock()
+        self.flushed_at = time.monotonic()
+        self.written = 0
+
+    def __enter__(self):
+        atexit.register(self.flush)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        atexit.unregister(self.flush)
+        self.flush()
+
+    def add(self, **fields):
+        """Добавляет запись лога, при заполнении буфера или по времени сохраняет накопленные записи"""
+        with self.lock:
+            self.logs.append(MailingLog(**fields))
+            due = (len(self.logs) >= self.flush_rows
+                   or time.monotonic() - self.flushed_at >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Сохраняет накопленные записи.
+        Буфер подменяется под блокировкой, поэтому другие потоки продолжают писать, пока идёт запрос к БД
+        :return: количество сохранённых записей
+        """
+        with self.lock:
+            logs, self.logs = self.logs, []
+            self.flushed_at = time.monotonic()
+        if not logs:
+            return 0
+        try:
+            with transaction.atomic():
+                MailingLog.objects.bulk_create(logs, batch_size=self.flush_rows)
+                add_to_daily_stats(logs)
+        except Exception:
+            # возвращаем записи в буфер, чтобы сохранить их при следующей попытке
+            with self.lock:
+                self.logs[:0] = logs
+            raise
+        self.written += len(logs)
+        return len(logs)
@@ -0,0 +1,19 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from mailing.stats import backfill_daily_stats
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает статистику отправки по дням из логов отправки писем'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=datetime.date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                            help='С какого дня пересчитать (по умолчанию - с самого старого лога)')
+        parser.add_argument('--until', type=datetime.date.fromisoformat, default=None, metavar='YYYY-MM-DD',
+                            help='По какой день включительно пересчитать (по умолчанию - по сегодня)')
+
+    def handle(self, *args, **options):
+        count = backfill_daily_stats(options['since'], options['until'])
+        self.stdout.write(f'Записей статистики по дням: {count}')
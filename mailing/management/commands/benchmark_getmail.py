@@ -0,0 +1,72 @@
+import json
+
+from django.conf import settings as django_settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mailing.loadtest import run_benchmark, run_mime_benchmark, compare_results, EMAIL_BACKENDS, RealMailError
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест отправки: полный запуск getmail по тестовым рассылкам (manage.py seed_load) '
+            'с локальным почтовым бэкендом')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', choices=tuple(EMAIL_BACKENDS), default='locmem',
+                            help='Почтовый бэкенд: письма в памяти или в файлах')
+        parser.add_argument('--file-path', default=None,
+                            help='Каталог для писем при --backend file (по умолчанию EMAIL_FILE_PATH)')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Количество потоков для параллельной отправки писем')
+        parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='Асинхронная отправка писем')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Максимальное количество одновременных отправок в асинхронном режиме')
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='Соблюдать лимиты скорости EMAIL_RATE_LIMITS (по умолчанию отключены)')
+        parser.add_argument('--mime', action='store_true',
+                            help='Только замер сборки писем без БД: MIME для каждого получателя или готовое письмо')
+        parser.add_argument('--mime-messages', type=int, default=3000,
+                            help='Количество писем для --mime')
+        parser.add_argument('--mime-body-kb', type=int, default=100,
+                            help='Размер текста письма в КБ для --mime')
+        parser.add_argument('--output', default=None,
+                            help='Файл для сохранения результата в формате JSON')
+        parser.add_argument('--baseline', default=None,
+                            help='Файл с результатом предыдущего теста для сравнения')
+        parser.add_argument('--tolerance', type=float, default=0.1,
+                            help='Допустимое ухудшение показателей относительно --baseline в долях')
+
+    def handle(self, *args, **options):
+        """
+        Назначает тестовые рассылки на сегодня и запускает getmail, измеряя скорость отправки,
+        количество запросов к БД на рассылку и пиковый объём памяти.
+        С опцией --mime вместо этого сравнивает скорость сборки писем: MIME для каждого получателя и готовое письмо.
+        Результат выводится и сохраняется в JSON, при --baseline сравнивается с предыдущим
+        и при ухудшении больше чем на --tolerance команда завершается с ошибкой
+        """
+        if options['backend'] == 'file' and not (options['file_path']
+                                                 or getattr(django_settings, 'EMAIL_FILE_PATH', None)):
+            raise CommandError('Для --backend file укажите --file-path')
+
+        if options['mime']:
+            result = run_mime_benchmark(options['mime_messages'], options['mime_body_kb'])
+        else:
+            getmail_options = {key: options[key] for key in ('workers', 'use_async', 'concurrency')}
+            try:
+                result = run_benchmark(options['backend'], options['file_path'], options['rate_limits'],
+                                       **getmail_options)
+            except RealMailError as e:
+                raise CommandError(e)
+        self.stdout.write(json.dumps(result, ensure_ascii=False, indent=2))
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump(result, file, ensure_ascii=False, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as file:
+                baseline = json.load(file)
+            regressions = compare_results(result, baseline, options['tolerance'])
+            if regressions:
+                raise CommandError('Показатели хуже, чем в --baseline: ' + '; '.join(regressions))
+            self.stdout.write(self.style.SUCCESS('Показатели не хуже, чем в --baseline'))
@@ -0,0 +1,38 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mailing.loadtest import run_recipients_benchmark, EMAIL_BACKENDS, LOAD_EMAIL_DOMAIN, RealMailError
+
+
+class Command(BaseCommand):
+    help = ('Замер памяти отправки рассылки на большое количество получателей '
+            f'(тестовые клиенты в домене {LOAD_EMAIL_DOMAIN} создаются при первом запуске)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, nargs='+', default=[1_000_000],
+                            help='Количество получателей рассылки; несколько значений - замер для каждого')
+        parser.add_argument('--backend', choices=tuple(EMAIL_BACKENDS), default='dummy',
+                            help='Почтовый бэкенд (dummy не хранит письма)')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Количество писем, забираемых из очереди за раз (по умолчанию EMAIL_BATCH_SIZE)')
+        parser.add_argument('--output', default=None,
+                            help='Файл для сохранения результатов в формате JSON')
+
+    def handle(self, *args, **options):
+        """
+        Для каждого количества получателей ставит письма рассылки в очередь и отправляет их,
+        выводя пиковую память Python на каждом этапе: при потоковой обработке получателей
+        она не растёт вместе с их количеством
+        """
+        stdout = self.stdout if options['verbosity'] > 1 else None
+        try:
+            results = [run_recipients_benchmark(clients, options['backend'], options['batch_size'], stdout)
+                       for clients in options['clients']]
+        except RealMailError as e:
+            raise CommandError(e)
+        self.stdout.write(json.dumps(results, ensure_ascii=False, indent=2))
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                json.dump(results, file, ensure_ascii=False, indent=2)
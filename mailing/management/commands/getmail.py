@@ -1,51 +1,163 @@
 import datetime
-import smtplib
+import json
+import logging
 
-import pytz
-from dateutil.relativedelta import relativedelta
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
-from mailing.models import MailingSettings, MailingLog
-from mailing.utils import get_mail_prepared, send_ready_mail
+from config import settings
+from mailing.async_sender import send_mail_async
+from mailing.dedupe import EmailSet
+from mailing.locks import RunLock
+from mailing.logwriter import BufferedLogWriter
+from mailing.metrics import metrics, save_metrics
+from mailing.models import MailingLog, MailingMessage, MailingSettings
+from mailing.outbox import DispatchReport, enqueue_mailing, drain_outbox, drain_outbox_parallel, get_claimable_rows
+from mailing.ratelimit import RateLimiter
+from mailing.sharding import Shard, register_node, SHARD_BY_MAILING, SHARD_BY_OWNER
+from mailing.utils import get_mail_prepared, get_due_settings, advance_sending_dates, catch_up_sending_dates, \
+    MailSender, format_batches_report, CATCH_UP_SEND, CATCH_UP_SKIP
+
+logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Количество потоков для параллельной отправки писем')
+        parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='Асинхронная отправка писем с ограничением числа одновременных отправок')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Максимальное количество одновременных отправок в асинхронном режиме')
+        parser.add_argument('--dedupe-run', action='store_true', default=settings.MAILING_DEDUPE_PER_RUN,
+                            help='Отправлять одному адресу не больше одного письма за запуск, даже из разных рассылок')
+        parser.add_argument('--catch-up', choices=(CATCH_UP_SEND, CATCH_UP_SKIP), default=None,
+                            help='Что делать с пропущенными датами отправки: отправить один раз или пропустить')
+        parser.add_argument('--shard', type=Shard.parse, default=None, metavar='K/N',
+                            help='Обрабатывать только K-ю из N частей рассылок (K от 0 до N-1) '
+                                 'для отправки с нескольких узлов')
+        parser.add_argument('--shard-by', choices=(SHARD_BY_MAILING, SHARD_BY_OWNER), default=SHARD_BY_MAILING,
+                            help='Делить рассылки между узлами по id рассылки или по владельцу')
+        parser.add_argument('--lock-wait', type=float, default=settings.MAILING_RUN_LOCK_WAIT,
+                            help='Сколько секунд ждать окончания предыдущего запуска (0 - сразу завершиться)')
+        parser.add_argument('--stats', action='store_true',
+                            help='Вывести метрики запуска в формате JSON')
+
     def handle(self, *args, **options):
         """
         Функция для обработки и отправки рассылок.
-        После отправки задаёт дату следующей.
-        Сообщения об отправках логируются.
+        Письма рассылок, которые нужно отправить сегодня, ставятся в очередь (по письму на адрес получателя,
+        с опцией --dedupe-run - по письму на адрес за весь запуск),
+        после чего задаётся дата следующей отправки. Пропущенные даты отправки переносятся на ближайшую
+        дату по расписанию, а сами рассылки по опции --catch-up отправляются один раз или пропускаются.
+        Затем очередь разбирается до конца, в том числе письма, оставшиеся от прерванных запусков.
+        Одновременно может работать только один запуск (для каждого шарда): если предыдущий запуск
+        ещё не завершён, новый ждёт не дольше --lock-wait секунд и завершается без отправки.
+        При включённых метриках (MAILING_METRICS_ENABLED) метрики запуска добавляются к накопленным в БД,
+        с опцией --stats они собираются в любом случае и выводятся в формате JSON.
+        С опцией --shard K/N в очередь ставится только K-я из N частей рассылок, так что N узлов делят
+        рассылки без дублей; очередь при этом разбирают все узлы вместе (строки очереди блокируются
+        SKIP LOCKED). При запуске проверяется, не пересекаются ли шарды с другими узлами.
+        Все письма за запуск отправляются через одно SMTP-соединение,
+        с опцией --workers N - пулом из N потоков, у каждого своё соединение,
+        с опцией --async - асинхронно с пулом переиспользуемых соединений.
+        Сообщения об отправках логируются вместе со временем отправки каждого пакета, а при
+        MAILING_LOG_PER_RECIPIENT - и по каждому письму; логи записываются в БД пачками через bulk_create.
         """
         curr_date = datetime.datetime.now().date()
+        shard = options['shard'] or Shard()
+        shard.key = options['shard_by']
+        for warning in register_node(shard):
+            self.stderr.write(self.style.WARNING(warning))
+
+        lock = RunLock(f'getmail:{shard.key}:{shard}')
+        if not lock.acquire(options['lock_wait']):
+            logger.warning('Предыдущий запуск отправки рассылок (%s) ещё не завершён, ожидание %.1f с, '
+                           'запуск пропущен', lock.name, lock.wait_time)
+            return
+        logger.info('Блокировка запуска %s получена, ожидание %.1f с', lock.name, lock.wait_time)
+        metrics_enabled = metrics.enabled
+        metrics.enabled = metrics_enabled or options['stats']
+        try:
+            with metrics.timer('mailing_run_seconds'):
+                self.send_mailings(curr_date, shard, options)
+        finally:
+            logger.info('Блокировка запуска %s снята, удерживалась %.1f с', lock.name, lock.release())
+            metrics.enabled = metrics_enabled
+
+        snapshot = metrics.collect()
+        if settings.MAILING_METRICS_ENABLED:
+            save_metrics(snapshot)
+        if options['stats']:
+            self.stdout.write(json.dumps(snapshot, ensure_ascii=False, indent=2))
+
+    def send_mailings(self, curr_date, shard, options):
+        """Ставит в очередь письма рассылок к отправке и разбирает очередь"""
+        get_mail_prepared(curr_date)
 
-        mail_to_handle = get_mail_prepared(curr_date).filter(setting__next_sending_date=curr_date)
+        with transaction.atomic():
+            # настройки к отправке читаются один раз: в очередь ставятся и сдвигаются одни и те же настройки,
+            # даже если за это время отправка по другим настройкам станет назначена на сегодня
+            due_settings_ids = list(get_due_settings(curr_date, shard).values_list('pk', flat=True))
+            overdue_mail_ids = catch_up_sending_dates(curr_date, options['catch_up'], shard)
+            mail_to_handle = MailingMessage.objects.filter(
+                Q(setting__pk__in=due_settings_ids) | Q(pk__in=overdue_mail_ids)
+            ).distinct()
+            seen = EmailSet() if options['dedupe_run'] else None
+            for mail in mail_to_handle:
+                enqueue_mailing(mail, curr_date, seen)
+            advance_sending_dates(MailingSettings.objects.filter(pk__in=due_settings_ids))
 
-        for mail in mail_to_handle:
+        if metrics.enabled:
+            metrics.set('mailing_outbox_depth', get_claimable_rows(timezone.now()).count())
+        with BufferedLogWriter() as log_writer:
+            report = DispatchReport(log_writer if settings.MAILING_LOG_PER_RECIPIENT else None)
+            # скорость отправки, сниженная после отказов сервиса в прошлых запусках, продолжает действовать
+            limiter = RateLimiter.load()
             try:
-                send_ready_mail(mail)
-                status = MailingLog.STATUS.SUCCESS
-                error_message = ''
-            except smtplib.SMTPException as e:
-                status = MailingLog.STATUS.FAILED
-                if 'authentication failed' in str(e):
-                    error_message = 'Ошибка аутентификации на сервисе'
-                elif 'suspicion of SPAM' in str(e):
-                    error_message = 'Слишком много рассылок, сервис отклонил письмо'
+                if options['use_async']:
+                    send_mail_async(report, options['concurrency'], limiter=limiter)
+                elif options['workers'] > 1:
+                    drain_outbox_parallel(options['workers'], report, limiter=limiter)
                 else:
-                    error_message = e
+                    with MailSender() as sender:
+                        drain_outbox(sender, report, limiter)
             finally:
-                MailingLog.objects.create(
-                    status=status,
-                    message=error_message,
-                    date=datetime.datetime.now().replace(tzinfo=pytz.UTC),
-                    mailing=mail
-                )
-
-            for setting in mail.settings.filter(message_id=mail.pk):
-                if setting.mailing_period == MailingSettings.FREQUENCY.DAILY:
-                    setting.next_sending_date += datetime.timedelta(days=1)
-                elif setting.mailing_period == MailingSettings.FREQUENCY.WEEKLY:
-                    setting.next_sending_date += datetime.timedelta(weeks=1)
-                elif setting.mailing_period == MailingSettings.FREQUENCY.MONTHLY:
-                    setting.next_sending_date = curr_date + relativedelta(months=+1)
-                setting.save()
+                limiter.save()
+
+            for mailing_id, result in report.items():
+                self.save_result(log_writer, mailing_id, result)
+
+    @staticmethod
+    def describe_error(error):
+        """Понятное описание ошибки отправки для лога рассылки"""
+        if 'authentication failed' in str(error):
+            return 'Ошибка аутентификации на сервисе'
+        if 'suspicion of SPAM' in str(error):
+            return 'Слишком много рассылок, сервис отклонил письмо'
+        return str(error)
+
+    def save_result(self, log_writer, mailing_id, result):
+        """Запись лога отправки рассылки за запуск (через буфер логов)"""
+        error = result['error']
+        if error is None:
+            sent = sum(count for count, _ in result['batches'])
+            # ничего не отправлено, все письма отложены (например, почтовый сервер недоступен)
+            status = MailingLog.STATUS.DEFERRED if result['deferred'] and not sent else MailingLog.STATUS.SUCCESS
+            error_message = format_batches_report(result['batches'])
+        else:
+            status = MailingLog.STATUS.FAILED
+            error_message = (f"{self.describe_error(error)}. Не отправлено писем: {result['failed']}. "
+                             f"{format_batches_report(result['batches'])}")
+        if result['deferred']:
+            error_message += (f". Отложено для повторной отправки писем: {result['deferred']} "
+                              f"({self.describe_error(result['deferred_error'])})")
+
+        log_writer.add(
+            status=status,
+            message=error_message,
+            date=timezone.now(),
+            mailing_id=mailing_id
+        )
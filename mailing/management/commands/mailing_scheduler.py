@@ -0,0 +1,94 @@
+import datetime
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from config import settings
+from mailing.metrics import metrics
+from mailing.scheduler import DueQueue, listen_for_changes, wait_for_changes, seconds_until, get_next_retry_at, \
+    parse_changes
+from mailing.sharding import Shard, SHARD_BY_MAILING, SHARD_BY_OWNER
+
+
+class Command(BaseCommand):
+    help = 'Планировщик рассылок: постоянно работающий процесс вместо запуска getmail по расписанию crontab'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--refresh-interval', type=int, default=settings.MAILING_SCHEDULER_REFRESH_INTERVAL,
+                            help='Через сколько секунд перечитывать даты отправки из БД без уведомлений')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Количество потоков для параллельной отправки писем')
+        parser.add_argument('--async', action='store_true', dest='use_async',
+                            help='Асинхронная отправка писем с ограничением числа одновременных отправок')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Максимальное количество одновременных отправок в асинхронном режиме')
+        parser.add_argument('--shard', type=Shard.parse, default=None, metavar='K/N',
+                            help='Обрабатывать только K-ю из N частей рассылок (K от 0 до N-1) '
+                                 'для отправки с нескольких узлов')
+        parser.add_argument('--shard-by', choices=(SHARD_BY_MAILING, SHARD_BY_OWNER), default=SHARD_BY_MAILING,
+                            help='Делить рассылки между узлами по id рассылки или по владельцу')
+
+    def handle(self, *args, **options):
+        """
+        Даты следующей отправки загружаются в мин-кучу, процесс спит до ближайшей из них
+        и запускает отправку (getmail) только когда есть рассылки к отправке или письма для повторной отправки.
+        После отправки перечитываются только даты отправленных рассылок, при изменении рассылок (уведомления
+        PostgreSQL LISTEN/NOTIFY с id изменённой записи) - только даты изменённых, поэтому работа планировщика
+        зависит от количества рассылок к отправке и изменений, а не от общего количества рассылок.
+        Все даты перечитываются раз в --refresh-interval секунд
+        """
+        getmail_options = {key: options[key] for key in ('workers', 'use_async', 'concurrency', 'shard', 'shard_by')}
+        shard = options['shard'] or Shard()
+        shard.key = options['shard_by']
+        queue = DueQueue(shard)
+        listener = listen_for_changes()
+        queue.load()
+        loaded_at = time.monotonic()
+        changed = True
+        last_run_date = None
+        # на какое время планировщик назначил следующую отправку (для метрики опоздания запуска)
+        wake_at = None
+
+        try:
+            while True:
+                today = datetime.date.today()
+                next_due = queue.peek()
+                next_retry_at = get_next_retry_at()
+                retry_due = next_retry_at is not None and next_retry_at <= timezone.now()
+                if retry_due or (next_due is not None and next_due <= today and (changed or last_run_date != today)):
+                    if wake_at is not None:
+                        metrics.observe('mailing_scheduler_lag_seconds',
+                                        max((timezone.now() - wake_at).total_seconds(), 0))
+                    metrics.set('mailing_scheduler_due_settings', len(queue))
+                    call_command('getmail', **getmail_options)
+                    last_run_date = today
+                    changed = False
+                    queue.reload_due(today)
+                    next_due = queue.peek()
+                    next_retry_at = get_next_retry_at()
+
+                timeout = options['refresh_interval']
+                if next_due is not None and next_due > today:
+                    timeout = min(timeout, seconds_until(next_due))
+                elif last_run_date == today:
+                    timeout = min(timeout, seconds_until(today + datetime.timedelta(days=1)))
+                if next_retry_at is not None:
+                    timeout = min(timeout, (next_retry_at - timezone.now()).total_seconds())
+                # письма к повтору могут быть заняты другим процессом getmail, поэтому ждём хотя бы секунду
+                timeout = max(timeout, 1)
+                wake_at = None
+                if timeout < options['refresh_interval']:
+                    wake_at = timezone.now() + datetime.timedelta(seconds=timeout)
+
+                payloads = wait_for_changes(listener, timeout)
+                changed = bool(payloads)
+                changes = parse_changes(payloads)
+                if changes is None or time.monotonic() - loaded_at >= options['refresh_interval']:
+                    queue.load()
+                    loaded_at = time.monotonic()
+                else:
+                    queue.reload(*changes)
+        except KeyboardInterrupt:
+            self.stdout.write('Планировщик рассылок остановлен')
@@ -0,0 +1,33 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from config import settings
+from mailing.models import MailingLog
+from mailing.stats import day_start
+from mailing.utils import prune_mailing_logs
+
+
+class Command(BaseCommand):
+    help = 'Удаляет старые логи отправки рассылок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.MAILING_LOG_RETENTION_DAYS, metavar='DAYS',
+                            help='Удалить логи старше указанного количества дней')
+        parser.add_argument('--batch-size', type=int, default=settings.MAILING_LOG_PRUNE_BATCH_SIZE,
+                            help='Сколько записей удалять одним запросом')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Пауза между пачками в секундах, чтобы снизить нагрузку на БД')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать логи, которые будут удалены')
+
+    def handle(self, *args, **options):
+        # граница - полночь: логи дня удаляются целиком, и статистика по дням из оставшихся логов не занижается
+        older_than = day_start(timezone.localdate() - datetime.timedelta(days=options['older_than']))
+        if options['dry_run']:
+            count = MailingLog.objects.filter(date__lt=older_than).count()
+            self.stdout.write(f'Логов старше {older_than:%d.%m.%Y}: {count}')
+            return
+        deleted = prune_mailing_logs(older_than, options['batch_size'], options['pause'])
+        self.stdout.write(f'Удалено логов старше {older_than:%d.%m.%Y}: {deleted}')
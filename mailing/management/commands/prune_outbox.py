@@ -0,0 +1,33 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from config import settings
+from mailing.models import MailingOutbox
+from mailing.outbox import prune_outbox
+
+
+class Command(BaseCommand):
+    help = 'Удаляет из очереди писем отправленные и недоставленные письма за прошедшие даты'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.OUTBOX_RETENTION_DAYS, metavar='DAYS',
+                            help='Удалить письма с датой отправки раньше указанного количества дней назад')
+        parser.add_argument('--batch-size', type=int, default=settings.MAILING_LOG_PRUNE_BATCH_SIZE,
+                            help='Сколько строк удалять одним запросом')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Пауза между пачками в секундах, чтобы снизить нагрузку на БД')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только посчитать письма, которые будут удалены')
+
+    def handle(self, *args, **options):
+        before_date = timezone.localdate() - datetime.timedelta(days=options['older_than'])
+        if options['dry_run']:
+            count = MailingOutbox.objects.filter(
+                status__in=(MailingOutbox.STATUS.SENT, MailingOutbox.STATUS.DEAD), send_date__lt=before_date
+            ).count()
+            self.stdout.write(f'Писем в очереди с датой отправки раньше {before_date:%d.%m.%Y}: {count}')
+            return
+        deleted = prune_outbox(before_date, options['batch_size'], options['pause'])
+        self.stdout.write(f'Удалено писем из очереди с датой отправки раньше {before_date:%d.%m.%Y}: {deleted}')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from mailing.loadtest import seed_load, LOAD_EMAIL_DOMAIN
+
+
+class Command(BaseCommand):
+    help = f'Заполняет БД тестовыми пользователями, клиентами и рассылками (адреса в домене {LOAD_EMAIL_DOMAIN})'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help='Количество пользователей')
+        parser.add_argument('--clients', type=int, default=100, help='Количество клиентов у каждого пользователя')
+        parser.add_argument('--mailings', type=int, default=5, help='Количество рассылок у каждого пользователя')
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Начальное значение генератора случайных чисел для повторяемых данных')
+
+    def handle(self, *args, **options):
+        users, clients, mailings = seed_load(options['users'], options['clients'], options['mailings'],
+                                             options['seed'], self.stdout if options['verbosity'] > 1 else None)
+        self.stdout.write(f'Создано пользователей: {users}, клиентов: {clients}, рассылок: {mailings}')
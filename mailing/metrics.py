@@ -0,0 +1,219 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from config import settings
+from mailing.models import MailingMetric
+
+# границы корзин гистограмм в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+HELP = {
+    'mailing_messages_sent_total': 'Отправлено писем',
+    'mailing_messages_failed_total': 'Писем с ошибкой отправки',
+    'mailing_messages_deferred_total': 'Писем, отложенных из-за ограничения скорости или ошибки соединения с сервисом',
+    'mailing_smtp_connect_seconds': 'Время открытия SMTP-соединения',
+    'mailing_smtp_send_seconds': 'Время отправки одного письма по SMTP',
+    'mailing_prepare_seconds': 'Время подготовки рассылок в БД (get_mail_prepared)',
+    'mailing_run_seconds': 'Время запуска getmail',
+    'mailing_outbox_depth': 'Писем в очереди к отправке в начале запуска',
+    'mailing_scheduler_due_settings': 'Настроек рассылок в куче планировщика',
+    'mailing_scheduler_lag_seconds': 'Опоздание запуска отправки планировщиком относительно назначенного времени',
+}
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # counts[i] - наблюдения в корзине i (не накопительно), последняя корзина - +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self):
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': {bound: count for bound, count in zip(bounds, self.counts) if count},
+        }
+
+
+class Metrics:
+    """
+    Счётчики, показатели и гистограммы процесса отправки рассылок.
+    Пока сбор выключен (MAILING_METRICS_ENABLED), все методы сразу возвращаются, а timer отдаёт пустой
+    контекстный менеджер, поэтому инструментирование почти ничего не стоит
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.histograms = defaultdict(Histogram)
+
+    def inc(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += value
+
+    def set(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def timer(self, name):
+        """Контекстный менеджер, записывающий время выполнения блока в гистограмму name"""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def timed(self, name):
+        """Декоратор, записывающий время выполнения функции в гистограмму name"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def collect(self):
+        """
+        Забирает накопленные значения и обнуляет их
+        :return: словарь {'counters': ..., 'gauges': ..., 'histograms': ...}
+        """
+        with self.lock:
+            snapshot = {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {name: histogram.as_dict() for name, histogram in self.histograms.items()},
+            }
+            self.reset()
+        return snapshot
+
+
+class Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.monotonic() - self.started)
+
+
+class NullTimer:
+    """Таймер для выключенного сбора метрик: один общий объект, который ничего не делает"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+metrics = Metrics(enabled=settings.MAILING_METRICS_ENABLED)
+
+
+def iter_series(snapshot):
+    """Раскладывает снимок метрик на строки MailingMetric: (вид, имя, метки, значение)"""
+    for name, value in snapshot['counters'].items():
+        yield MailingMetric.KIND.COUNTER, name, '', value
+    for name, value in snapshot['gauges'].items():
+        yield MailingMetric.KIND.GAUGE, name, '', value
+    for name, histogram in snapshot['histograms'].items():
+        for bound, count in histogram['buckets'].items():
+            yield MailingMetric.KIND.HISTOGRAM, f'{name}_bucket', f'le="{bound}"', count
+        yield MailingMetric.KIND.HISTOGRAM, f'{name}_sum', '', histogram['sum']
+        yield MailingMetric.KIND.HISTOGRAM, f'{name}_count', '', histogram['count']
+
+
+def save_metrics(snapshot):
+    """
+    Добавляет снимок метрик запуска к накопленным в БД значениям, чтобы их видел веб-процесс.
+    Счётчики и гистограммы складываются, показатели перезаписываются
+    """
+    for kind, name, labels, value in iter_series(snapshot):
+        series = MailingMetric.objects.filter(name=name, labels=labels)
+        if kind == MailingMetric.KIND.GAUGE:
+            updated = series.update(value=value)
+        else:
+            updated = series.update(value=F('value') + value)
+        if updated:
+            continue
+        try:
+            with transaction.atomic():
+                MailingMetric.objects.create(kind=kind, name=name, labels=labels, value=value)
+        except IntegrityError:
+            # строку успел создать параллельный запуск
+            series.update(value=value if kind == MailingMetric.KIND.GAUGE else F('value') + value)
+
+
+def get_metric_base_name(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_prometheus():
+    """
+    Метрики из БД в текстовом формате Prometheus.
+    У гистограмм выводятся все корзины DEFAULT_BUCKETS с накопительными значениями
+    """
+    kinds = {}
+    values = defaultdict(dict)
+    for kind, name, labels, value in MailingMetric.objects.values_list('kind', 'name', 'labels', 'value'):
+        base_name = get_metric_base_name(name) if kind == MailingMetric.KIND.HISTOGRAM else name
+        kinds[base_name] = kind
+        values[base_name][(name, labels)] = value
+
+    lines = []
+    for base_name in sorted(kinds):
+        if base_name in HELP:
+            lines.append(f'# HELP {base_name} {HELP[base_name]}')
+        lines.append(f'# TYPE {base_name} {kinds[base_name]}')
+        series = values[base_name]
+        if kinds[base_name] == MailingMetric.KIND.HISTOGRAM:
+            total = 0
+            for bound in [str(bound) for bound in DEFAULT_BUCKETS] + ['+Inf']:
+                labels = f'le="{bound}"'
+                total += series.get((f'{base_name}_bucket', labels), 0)
+                lines.append(f'{base_name}_bucket{{{labels}}} {format_value(total)}')
+            for suffix in ('_sum', '_count'):
+                lines.append(f'{base_name}{suffix} {format_value(series.get((base_name + suffix, ""), 0))}')
+        else:
+            lines.append(f'{base_name} {format_value(series[(base_name, "")])}')
+    return '\n'.join(lines) + '\n'
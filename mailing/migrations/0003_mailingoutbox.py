@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0002_initial'),
+        ('mailing', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('send_date', models.DateField(verbose_name='дата отправки')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('sending', 'Отправляется'), ('sent', 'Отправлено'), ('failed', 'Не отправлено')], default='pending', max_length=10, verbose_name='статус отправки')),
+                ('claimed_at', models.DateTimeField(blank=True, null=True, verbose_name='взято в работу')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='время отправки')),
+                ('error', models.TextField(blank=True, null=True, verbose_name='ответ сервера')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbox', to='clients.client', verbose_name='получатель')),
+                ('mailing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outbox', to='mailing.mailingmessage', verbose_name='рассылка')),
+            ],
+            options={
+                'verbose_name': 'письмо в очереди',
+                'verbose_name_plural': 'очередь писем',
+                'ordering': ('pk',),
+                'indexes': [models.Index(fields=['status', 'claimed_at'], name='outbox_status_claimed_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='mailingoutbox',
+            constraint=models.UniqueConstraint(fields=('mailing', 'client', 'send_date'), name='unique_outbox_recipient'),
+        ),
+    ]
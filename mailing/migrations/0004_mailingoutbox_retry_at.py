@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0003_mailingoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailingoutbox',
+            name='retry_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='повторить не раньше'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0004_mailingoutbox_retry_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailingoutbox',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='неудачных попыток'),
+        ),
+        migrations.AlterField(
+            model_name='mailingoutbox',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В очереди'), ('sending', 'Отправляется'), ('sent', 'Отправлено'), ('failed', 'Ошибка, будет повторено'), ('dead', 'Не доставлено')], default='pending', max_length=10, verbose_name='статус отправки'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0005_mailingoutbox_attempts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mailingsettings',
+            index=models.Index(fields=['mailing_status', 'next_sending_date'], name='settings_status_next_date_idx'),
+        ),
+    ]
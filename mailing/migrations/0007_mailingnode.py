@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0006_mailingsettings_status_next_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='узел')),
+                ('shard_index', models.PositiveIntegerField(default=0, verbose_name='номер шарда')),
+                ('shard_count', models.PositiveIntegerField(default=1, verbose_name='количество шардов')),
+                ('shard_key', models.CharField(default='mailing', max_length=10, verbose_name='ключ шардирования')),
+                ('last_seen', models.DateTimeField(verbose_name='последний запуск')),
+            ],
+            options={
+                'verbose_name': 'узел отправки',
+                'verbose_name_plural': 'узлы отправки',
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0007_mailingnode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingRunLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='блокировка')),
+                ('token', models.CharField(max_length=32, verbose_name='владелец')),
+                ('expires_at', models.DateTimeField(verbose_name='действует до')),
+            ],
+            options={
+                'verbose_name': 'блокировка запуска',
+                'verbose_name_plural': 'блокировки запуска',
+            },
+        ),
+    ]
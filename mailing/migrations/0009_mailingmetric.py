@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0008_mailingrunlock'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingMetric',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('counter', 'Счётчик'), ('gauge', 'Показатель'), ('histogram', 'Гистограмма')], max_length=10, verbose_name='вид')),
+                ('name', models.CharField(max_length=255, verbose_name='метрика')),
+                ('labels', models.CharField(blank=True, default='', max_length=255, verbose_name='метки')),
+                ('value', models.FloatField(default=0, verbose_name='значение')),
+            ],
+            options={
+                'verbose_name': 'метрика',
+                'verbose_name_plural': 'метрики',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='mailingmetric',
+            constraint=models.UniqueConstraint(fields=('name', 'labels'), name='unique_metric_series'),
+        ),
+    ]
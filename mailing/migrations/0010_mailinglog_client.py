@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0002_initial'),
+        ('mailing', '0009_mailingmetric'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailinglog',
+            name='client',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mailing_logs', to='clients.client', verbose_name='получатель'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0010_mailinglog_client'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='mailinglog',
+            options={'ordering': ('-date',), 'verbose_name': 'лог', 'verbose_name_plural': 'логи'},
+        ),
+        migrations.AddIndex(
+            model_name='mailinglog',
+            index=models.Index(fields=['date'], name='log_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mailinglog',
+            index=models.Index(fields=['mailing', 'date'], name='log_mailing_date_idx'),
+        ),
+    ]
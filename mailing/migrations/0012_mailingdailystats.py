@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:47
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mailing', '0011_mailinglog_date_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='день')),
+                ('status', models.CharField(choices=[('Успешно', 'Success'), ('Неуспешно', 'Failed')], max_length=9, verbose_name='статус отправки')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='писем')),
+                ('mailing', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='daily_stats', to='mailing.mailingmessage', verbose_name='рассылка')),
+                ('owner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='mailing_stats', to=settings.AUTH_USER_MODEL, verbose_name='владелец рассылки')),
+            ],
+            options={
+                'verbose_name': 'статистика отправки за день',
+                'verbose_name_plural': 'статистика отправки по дням',
+                'ordering': ('-day',),
+                'indexes': [models.Index(fields=['owner', 'day'], name='daily_stats_owner_day_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='mailingdailystats',
+            constraint=models.UniqueConstraint(fields=('mailing', 'day', 'status'), name='unique_daily_stats'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0012_mailingdailystats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mailingoutbox',
+            index=models.Index(fields=['status', 'send_date'], name='outbox_status_send_date_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0013_outbox_status_send_date_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailingRateLimit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=10, verbose_name='вид ограничения')),
+                ('key', models.CharField(max_length=255, verbose_name='сервер или владелец')),
+                ('rate', models.FloatField(verbose_name='писем в секунду')),
+                ('updated_at', models.DateTimeField(verbose_name='обновлено')),
+            ],
+            options={
+                'verbose_name': 'ограничение скорости отправки',
+                'verbose_name_plural': 'ограничения скорости отправки',
+            },
+        ),
+        migrations.AddField(
+            model_name='mailingoutbox',
+            name='deferrals',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='отложено из-за ограничения скорости'),
+        ),
+        migrations.AddConstraint(
+            model_name='mailingratelimit',
+            constraint=models.UniqueConstraint(fields=('kind', 'key'), name='unique_rate_limit'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0014_outbox_deferrals_rate_limit'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mailingdailystats',
+            name='status',
+            field=models.CharField(choices=[('Успешно', 'Success'), ('Неуспешно', 'Failed'), ('Отложено', 'Deferred')], max_length=9, verbose_name='статус отправки'),
+        ),
+        migrations.AlterField(
+            model_name='mailinglog',
+            name='status',
+            field=models.CharField(blank=True, choices=[('Успешно', 'Success'), ('Неуспешно', 'Failed'), ('Отложено', 'Deferred')], max_length=9, null=True, verbose_name='статус отправки'),
+        ),
+    ]
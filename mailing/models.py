@@ -1,3 +1,6 @@
+import datetime
+
+from dateutil.relativedelta import relativedelta
 from django.db import models
 from django.db.models import ForeignKey
 
@@ -58,6 +61,9 @@ class MailingSettings(models.Model):
         verbose_name = 'настройки рассылки'
         verbose_name_plural = 'настройки рассылки'
         ordering = ('mailing_start', 'mailing_end',)
+        indexes = [
+            models.Index(fields=('mailing_status', 'next_sending_date'), name='settings_status_next_date_idx'),
+        ]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -75,16 +81,54 @@ class MailingSettings(models.Model):
     def get_mailing_period_display(self):
         return dict(self.FREQUENCY.choices).get(self.mailing_period, 'Не указано')
 
+    def get_next_sending_date(self):
+        """
+        Дата следующей отправки после текущей в зависимости от периодичности.
+        Ежемесячные рассылки считаются от даты начала, чтобы короткие месяцы не сдвигали число отправки
+        (31.01 -> 28.02 -> 31.03)
+        """
+        if self.mailing_period == self.FREQUENCY.DAILY:
+            return self.next_sending_date + datetime.timedelta(days=1)
+        if self.mailing_period == self.FREQUENCY.WEEKLY:
+            return self.next_sending_date + datetime.timedelta(weeks=1)
+        if self.mailing_period == self.FREQUENCY.MONTHLY:
+            start = self.mailing_start or self.next_sending_date
+            months = ((self.next_sending_date.year - start.year) * 12
+                      + self.next_sending_date.month - start.month + 1)
+            return start + relativedelta(months=months)
+        return self.next_sending_date
+
+    def get_sending_date_on_or_after(self, date):
+        """Первая дата отправки по расписанию рассылки не раньше date (для пропущенных отправок)"""
+        if self.next_sending_date >= date:
+            return self.next_sending_date
+        if self.mailing_period == self.FREQUENCY.DAILY:
+            return date
+        if self.mailing_period == self.FREQUENCY.WEEKLY:
+            weeks = -(-(date - self.next_sending_date).days // 7)
+            return self.next_sending_date + datetime.timedelta(weeks=weeks)
+        if self.mailing_period == self.FREQUENCY.MONTHLY:
+            start = self.mailing_start or self.next_sending_date
+            months = (date.year - start.year) * 12 + date.month - start.month
+            if start + relativedelta(months=months) < date:
+                months += 1
+            return start + relativedelta(months=months)
+        return self.next_sending_date
+
 
 class MailingLog(models.Model):
     class STATUS(models.TextChoices):
         SUCCESS = 'Успешно'
         FAILED = 'Неуспешно'
+        # письмо возвращено в очередь без засчитанной попытки (ограничение скорости или ошибка соединения)
+        DEFERRED = 'Отложено'
 
     status = models.CharField(max_length=9, choices=STATUS.choices, **NULLABLE, verbose_name='статус отправки')
     message = models.TextField(**NULLABLE, verbose_name='ответ сервера')
     date = models.DateTimeField(**NULLABLE, verbose_name='время попытки')
     mailing = models.ForeignKey(MailingMessage, **NULLABLE, on_delete=models.SET_NULL, verbose_name='рассылка')
+    client = models.ForeignKey(Client, **NULLABLE, on_delete=models.SET_NULL,
+                               related_name='mailing_logs', verbose_name='получатель')
 
     def __str__(self):
         return f'{self.date} - {self.status}'
@@ -92,4 +136,145 @@ class MailingLog(models.Model):
     class Meta:
         verbose_name = 'лог'
         verbose_name_plural = 'логи'
-        ordering = ('status',)
+        ordering = ('-date',)
+        indexes = [
+            models.Index(fields=('date',), name='log_date_idx'),
+            models.Index(fields=('mailing', 'date'), name='log_mailing_date_idx'),
+        ]
+
+
+class MailingOutbox(models.Model):
+    """Очередь писем: одна строка на получателя рассылки за дату отправки"""
+
+    class STATUS(models.TextChoices):
+        PENDING = 'pending', 'В очереди'
+        SENDING = 'sending', 'Отправляется'
+        SENT = 'sent', 'Отправлено'
+        FAILED = 'failed', 'Ошибка, будет повторено'
+        DEAD = 'dead', 'Не доставлено'
+
+    mailing = models.ForeignKey(MailingMessage, on_delete=models.CASCADE,
+                                related_name='outbox', verbose_name='рассылка')
+    client = models.ForeignKey(Client, on_delete=models.CASCADE,
+                               related_name='outbox', verbose_name='получатель')
+    send_date = models.DateField(verbose_name='дата отправки')
+    status = models.CharField(max_length=10, choices=STATUS.choices,
+                              default=STATUS.PENDING, verbose_name='статус отправки')
+    claimed_at = models.DateTimeField(**NULLABLE, verbose_name='взято в работу')
+    sent_at = models.DateTimeField(**NULLABLE, verbose_name='время отправки')
+    retry_at = models.DateTimeField(**NULLABLE, verbose_name='повторить не раньше')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='неудачных попыток')
+    deferrals = models.PositiveSmallIntegerField(default=0, verbose_name='отложено из-за ограничения скорости')
+    error = models.TextField(**NULLABLE, verbose_name='ответ сервера')
+
+    def __str__(self):
+        return f'{self.send_date} - {self.client_id} - {self.status}'
+
+    class Meta:
+        verbose_name = 'письмо в очереди'
+        verbose_name_plural = 'очередь писем'
+        ordering = ('pk',)
+        constraints = [
+            models.UniqueConstraint(fields=('mailing', 'client', 'send_date'), name='unique_outbox_recipient'),
+        ]
+        indexes = [
+            models.Index(fields=('status', 'claimed_at'), name='outbox_status_claimed_idx'),
+            models.Index(fields=('status', 'send_date'), name='outbox_status_send_date_idx'),
+        ]
+
+
+class MailingNode(models.Model):
+    """Узел, на котором запускается отправка рассылок, и его часть (шард) рассылок"""
+    name = models.CharField(max_length=255, unique=True, verbose_name='узел')
+    shard_index = models.PositiveIntegerField(default=0, verbose_name='номер шарда')
+    shard_count = models.PositiveIntegerField(default=1, verbose_name='количество шардов')
+    shard_key = models.CharField(max_length=10, default='mailing', verbose_name='ключ шардирования')
+    last_seen = models.DateTimeField(verbose_name='последний запуск')
+
+    def __str__(self):
+        return f'{self.name} - {self.shard_index}/{self.shard_count}'
+
+    class Meta:
+        verbose_name = 'узел отправки'
+        verbose_name_plural = 'узлы отправки'
+
+
+class MailingRunLock(models.Model):
+    """Блокировка запуска отправки для БД без рекомендательных блокировок (не PostgreSQL)"""
+    name = models.CharField(max_length=255, unique=True, verbose_name='блокировка')
+    token = models.CharField(max_length=32, verbose_name='владелец')
+    expires_at = models.DateTimeField(verbose_name='действует до')
+
+    def __str__(self):
+        return f'{self.name} - {self.expires_at}'
+
+    class Meta:
+        verbose_name = 'блокировка запуска'
+        verbose_name_plural = 'блокировки запуска'
+
+
+class MailingRateLimit(models.Model):
+    """Скорость отправки, сниженная ограничителем после отказов почтового сервиса, для следующих запусков"""
+    kind = models.CharField(max_length=10, verbose_name='вид ограничения')
+    key = models.CharField(max_length=255, verbose_name='сервер или владелец')
+    rate = models.FloatField(verbose_name='писем в секунду')
+    updated_at = models.DateTimeField(verbose_name='обновлено')
+
+    def __str__(self):
+        return f'{self.kind} {self.key}: {self.rate}'
+
+    class Meta:
+        verbose_name = 'ограничение скорости отправки'
+        verbose_name_plural = 'ограничения скорости отправки'
+        constraints = [
+            models.UniqueConstraint(fields=('kind', 'key'), name='unique_rate_limit'),
+        ]
+
+
+class MailingMetric(models.Model):
+    """Накопленное значение метрики отправки рассылок (ряд в формате Prometheus)"""
+
+    class KIND(models.TextChoices):
+        COUNTER = 'counter', 'Счётчик'
+        GAUGE = 'gauge', 'Показатель'
+        HISTOGRAM = 'histogram', 'Гистограмма'
+
+    kind = models.CharField(max_length=10, choices=KIND.choices, verbose_name='вид')
+    name = models.CharField(max_length=255, verbose_name='метрика')
+    labels = models.CharField(max_length=255, blank=True, default='', verbose_name='метки')
+    value = models.FloatField(default=0, verbose_name='значение')
+
+    def __str__(self):
+        return f'{self.name}{{{self.labels}}} {self.value}'
+
+    class Meta:
+        verbose_name = 'метрика'
+        verbose_name_plural = 'метрики'
+        constraints = [
+            models.UniqueConstraint(fields=('name', 'labels'), name='unique_metric_series'),
+        ]
+
+
+class MailingDailyStats(models.Model):
+    """Количество писем за день по рассылке и статусу отправки, собирается из логов отправки каждого письма"""
+    day = models.DateField(verbose_name='день')
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, **NULLABLE, on_delete=models.CASCADE,
+                              related_name='mailing_stats', verbose_name='владелец рассылки')
+    mailing = models.ForeignKey(MailingMessage, **NULLABLE, on_delete=models.SET_NULL,
+                                related_name='daily_stats', verbose_name='рассылка')
+    status = models.CharField(max_length=9, choices=MailingLog.STATUS.choices, verbose_name='статус отправки')
+    count = models.PositiveIntegerField(default=0, verbose_name='писем')
+
+    def __str__(self):
+        return f'{self.day} - {self.mailing_id} - {self.status}: {self.count}'
+
+    class Meta:
+        verbose_name = 'статистика отправки за день'
+        verbose_name_plural = 'статистика отправки по дням'
+        ordering = ('-day',)
+        constraints = [
+            models.UniqueConstraint(fields=('mailing', 'day', 'status'), name='unique_daily_stats'),
+        ]
+        indexes = [
+            models.Index(fields=('owner', 'day'), name='daily_stats_owner_day_idx'),
+        ]
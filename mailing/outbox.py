@@ -0,0 +1,302 @@
+import datetime
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+import config.settings
+from mailing.dedupe import EmailSet
+from mailing.metrics import metrics
+from mailing.models import MailingMessage, MailingOutbox, MailingLog
+from mailing.ratelimit import RateLimiter, is_throttled, is_permanent, is_connection_error
+from mailing.utils import MailSender, build_message, iter_chunks, delete_in_batches
+
+
+class DispatchReport:
+    """
+    Сводка отправки писем из очереди за запуск по каждой рассылке.
+    Если передан log_writer (BufferedLogWriter), в него пишется лог отправки каждого письма
+    """
+
+    def __init__(self, log_writer=None):
+        self.log_writer = log_writer
+        self.lock = threading.Lock()
+        self.mailings = defaultdict(lambda: {'batches': [], 'failed': 0, 'deferred': 0, 'error': None,
+                                             'deferred_error': None})
+
+    def add(self, sent, failed, elapsed):
+        """
+        Учитывает результат отправки пакета
+        :param sent: отправленные строки очереди
+        :param failed: пары (строка очереди, исключение) после записи результата в очередь (complete_batch)
+        :param elapsed: время отправки пакета в секундах
+        """
+        sent_by_mailing = defaultdict(int)
+        for row in sent:
+            sent_by_mailing[row.mailing_id] += 1
+        metrics.inc('mailing_messages_sent_total', len(sent))
+        with self.lock:
+            for mailing_id, count in sent_by_mailing.items():
+                self.mailings[mailing_id]['batches'].append((count, elapsed))
+            for row, error in failed:
+                # письма, отложенные из-за лимитов или ошибки соединения, complete_batch возвращает в очередь
+                # без засчитанной попытки, в логе отправки письма они тоже отложенные
+                if row.status == MailingOutbox.STATUS.PENDING:
+                    metrics.inc('mailing_messages_deferred_total')
+                    self.mailings[row.mailing_id]['deferred'] += 1
+                    self.mailings[row.mailing_id]['deferred_error'] = error
+                else:
+                    metrics.inc('mailing_messages_failed_total')
+                    self.mailings[row.mailing_id]['failed'] += 1
+                    self.mailings[row.mailing_id]['error'] = error
+
+    def items(self):
+        return self.mailings.items()
+
+
+def enqueue_mailing(mail, send_date, seen=None):
+    """
+    Ставит в очередь письма всем получателям рассылки за дату отправки.
+    Получатели с одинаковым адресом (без учёта регистра) получают одно письмо.
+    Получатели читаются и записываются в очередь частями по EMAIL_RECIPIENTS_CHUNK_SIZE,
+    поэтому память не зависит от размера рассылки. Повторный вызов за ту же дату не создаёт дублей
+    :param mail: рассылка
+    :param send_date: дата отправки
+    :param seen: EmailSet адресов, уже поставленных в очередь за запуск, если дубли нужно убирать
+    и между рассылками; по умолчанию дубли убираются только внутри рассылки
+    """
+    seen = EmailSet() if seen is None else seen
+    chunk_size = config.settings.EMAIL_RECIPIENTS_CHUNK_SIZE
+    recipients = mail.recipient.order_by('pk').values_list('pk', 'email').iterator(chunk_size=chunk_size)
+    for chunk in iter_chunks(recipients, chunk_size):
+        MailingOutbox.objects.bulk_create(
+            [MailingOutbox(mailing=mail, client_id=client_id, send_date=send_date)
+             for client_id, email in chunk if seen.add(email)],
+            ignore_conflicts=True
+        )
+
+
+# поля строки очереди и получателя, нужные для отправки письма и записи результата
+CLAIM_FIELDS = ('mailing', 'attempts', 'deferrals', 'client__email', 'client__name', 'client__comment')
+
+
+def get_claimable_rows(now):
+    """Строки очереди, которые можно взять в отправку в момент now"""
+    stale = now - datetime.timedelta(seconds=config.settings.OUTBOX_CLAIM_TIMEOUT)
+    return (MailingOutbox.objects
+            .filter(Q(status__in=(MailingOutbox.STATUS.PENDING, MailingOutbox.STATUS.FAILED))
+                    | Q(status=MailingOutbox.STATUS.SENDING, claimed_at__lt=stale))
+            .filter(Q(retry_at__isnull=True) | Q(retry_at__lte=now)))
+
+
+def claim_batch(batch_size=None):
+    """
+    Забирает из очереди пакет писем для отправки.
+    Строки блокируются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому несколько процессов getmail
+    разбирают очередь без повторной отправки. Письма, взятые в работу больше OUTBOX_CLAIM_TIMEOUT секунд назад
+    и так и не отправленные, забираются повторно. Отложенные и неудачные письма забираются после наступления retry_at.
+    Из строк и получателей читаются только нужные для отправки поля, а рассылки пакета - отдельным запросом
+    по одному разу (attach_mailings), чтобы текст рассылки не копировался в каждую строку
+    :return: список строк очереди со статусом "отправляется"
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            get_claimable_rows(now)
+            .select_for_update(skip_locked=True, of=('self',))
+            .select_related('client')
+            .only(*CLAIM_FIELDS)
+            [:batch_size or config.settings.EMAIL_BATCH_SIZE]
+        )
+        if rows:
+            MailingOutbox.objects.filter(pk__in=[row.pk for row in rows]).update(
+                status=MailingOutbox.STATUS.SENDING, claimed_at=now
+            )
+    attach_mailings(rows)
+    return rows
+
+
+def attach_mailings(rows):
+    """Загружает рассылки строк очереди одним запросом, строки одной рассылки получают один и тот же объект"""
+    if not rows:
+        return
+    mailings = MailingMessage.objects.only('subject', 'body', 'owner').in_bulk({row.mailing_id for row in rows})
+    for row in rows:
+        row.mailing = mailings[row.mailing_id]
+
+
+def send_batch(sender, rows, limiter=None):
+    """
+    Отправка писем по строкам очереди с соблюдением лимитов скорости, к БД не обращается.
+    При ошибке соединения с почтовым сервером (is_connection_error) отправка пакета прекращается:
+    это письмо и оставшиеся письма пакета возвращаются как неотправленные с той же ошибкой
+    :param sender: MailSender
+    :param rows: строки очереди с загруженными рассылкой и получателем
+    :param limiter: RateLimiter, общий для всех потоков отправки
+    :return: отправленные строки, пары (строка, исключение) для неотправленных, время отправки в секундах
+    """
+    host = getattr(sender.connection, 'host', None)
+    started = time.monotonic()
+    sent, failed = [], []
+    for i, row in enumerate(rows):
+        if limiter is not None:
+            limiter.acquire(host, row.mailing.owner_id)
+        try:
+            sender.send_message(build_message(row.mailing, row.client.email, row.client))
+            sent.append(row)
+            throttled = False
+        except Exception as e:
+            # любая ошибка относится только к этому письму:
+            # остальные письма пакета отправляются, а результат всего пакета записывается в очередь
+            if is_connection_error(e):
+                failed.extend((rest, e) for rest in rows[i:])
+                break
+            failed.append((row, e))
+            throttled = is_throttled(e)
+        if limiter is not None:
+            limiter.feedback(host, row.mailing.owner_id, throttled)
+    return sent, failed, time.monotonic() - started
+
+
+def is_batch_aborted(failed):
+    """Проверяет, прервана ли отправка пакета ошибкой соединения (дальше отправлять в этом запуске бессмысленно)"""
+    return bool(failed) and is_connection_error(failed[-1][1])
+
+
+def get_retry_delay(attempts):
+    """
+    Задержка перед повторной отправкой в секундах: экспоненциальный рост с ограничением EMAIL_RETRY['max_delay']
+    и случайным разбросом, чтобы после сбоя повторные письма не уходили все одновременно
+    :param attempts: количество неудачных попыток, включая текущую
+    """
+    retry = config.settings.EMAIL_RETRY
+    delay = min(retry['max_delay'], retry['base_delay'] * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def complete_batch(sent, failed, log_writer=None):
+    """
+    Записывает в очередь результат отправки пакета.
+    Письма, отклонённые сервисом из-за превышения лимитов, возвращаются в очередь
+    и повторяются через EMAIL_RATE_LIMITS['retry_delay'] секунд, попытка при этом не засчитывается
+    (не больше EMAIL_RATE_LIMITS['max_deferrals'] раз, дальше отказ считается обычной неудачной попыткой).
+    Письма, не отправленные из-за ошибки соединения с почтовым сервером (сервер недоступен, ошибка авторизации,
+    отклонён отправитель), возвращаются в очередь без засчитанной попытки с задержкой get_retry_delay(1)
+    (от половины до EMAIL_RETRY['base_delay'] секунд, чтобы после сбоя письма не повторялись все одновременно):
+    сбой сервиса не должен исчерпывать попытки всех писем очереди.
+    Остальные неудачные письма повторяются с экспоненциальной задержкой, а после EMAIL_RETRY['max_attempts']
+    попыток или при окончательном отказе сервера в приёме письма получателю помечаются недоставленными
+    :param log_writer: BufferedLogWriter для лога отправки каждого письма
+    """
+    now = timezone.now()
+    if sent:
+        MailingOutbox.objects.filter(pk__in=[row.pk for row in sent]).update(
+            status=MailingOutbox.STATUS.SENT, sent_at=now, error=None
+        )
+    rate_limits = config.settings.EMAIL_RATE_LIMITS
+    throttled_delay = datetime.timedelta(seconds=rate_limits['retry_delay'])
+    for row, error in failed:
+        row.error = str(error)
+        row.claimed_at = None
+        if is_connection_error(error):
+            row.status = MailingOutbox.STATUS.PENDING
+            # та же задержка со случайным разбросом, что и у первой повторной попытки
+            row.retry_at = now + datetime.timedelta(seconds=get_retry_delay(1))
+            continue
+        if is_throttled(error) and row.deferrals < rate_limits['max_deferrals']:
+            row.status = MailingOutbox.STATUS.PENDING
+            row.retry_at = now + throttled_delay
+            row.deferrals += 1
+            continue
+        row.attempts += 1
+        if is_permanent(error) or row.attempts >= config.settings.EMAIL_RETRY['max_attempts']:
+            row.status = MailingOutbox.STATUS.DEAD
+            row.retry_at = None
+        else:
+            row.status = MailingOutbox.STATUS.FAILED
+            row.retry_at = now + datetime.timedelta(seconds=get_retry_delay(row.attempts))
+    MailingOutbox.objects.bulk_update([row for row, _ in failed],
+                                      ['status', 'error', 'claimed_at', 'retry_at', 'attempts', 'deferrals'])
+    if log_writer is not None:
+        log_delivery(log_writer, sent, failed, now)
+
+
+def log_delivery(log_writer, sent, failed, now):
+    """
+    Добавляет в буфер логов результат отправки каждого письма пакета.
+    Письма, возвращённые в очередь без засчитанной попытки, записываются со статусом "отложено"
+    """
+    for row in sent:
+        log_writer.add(status=MailingLog.STATUS.SUCCESS, message=f'Отправлено на {row.client.email}',
+                       date=now, mailing_id=row.mailing_id, client_id=row.client_id)
+    for row, error in failed:
+        status = MailingLog.STATUS.FAILED
+        if is_connection_error(error):
+            status, outcome = MailingLog.STATUS.DEFERRED, 'ошибка соединения с сервисом, письмо отложено'
+        elif row.status == MailingOutbox.STATUS.PENDING:
+            status, outcome = MailingLog.STATUS.DEFERRED, 'сервис ограничил скорость, письмо отложено'
+        elif row.status == MailingOutbox.STATUS.DEAD:
+            outcome = 'письмо не доставлено'
+        else:
+            outcome = f'будет повторено, попытка {row.attempts}'
+        log_writer.add(status=status, message=f'{row.client.email}: {error} ({outcome})',
+                       date=now, mailing_id=row.mailing_id, client_id=row.client_id)
+
+
+def prune_outbox(before_date, batch_size=None, pause=0):
+    """
+    Удаляет из очереди отправленные и недоставленные письма с датой отправки раньше before_date
+    пачками по batch_size строк. Письма, которые ещё ждут отправки или повтора, не удаляются
+    :param pause: пауза между пачками в секундах
+    :return: количество удалённых строк
+    """
+    finished = MailingOutbox.objects.filter(status__in=(MailingOutbox.STATUS.SENT, MailingOutbox.STATUS.DEAD),
+                                            send_date__lt=before_date)
+    return delete_in_batches(finished.order_by('send_date'),
+                             batch_size or config.settings.MAILING_LOG_PRUNE_BATCH_SIZE, pause)
+
+
+def drain_outbox(sender, report, limiter=None, batch_size=None):
+    """
+    Отправка писем из очереди, пока она не опустеет или не возникнет ошибка соединения с почтовым сервером
+    :param sender: MailSender
+    :param report: DispatchReport для сводки по рассылкам
+    :param limiter: RateLimiter, по умолчанию создаётся новый
+    """
+    limiter = limiter or RateLimiter()
+    while True:
+        rows = claim_batch(batch_size)
+        if not rows:
+            break
+        sent, failed, elapsed = send_batch(sender, rows, limiter)
+        complete_batch(sent, failed, report.log_writer)
+        report.add(sent, failed, elapsed)
+        if is_batch_aborted(failed):
+            break
+
+
+def drain_outbox_parallel(workers, report, batch_size=None, limiter=None):
+    """
+    Отправка писем из очереди пулом потоков.
+    У каждого потока своё SMTP-соединение и своё соединение с БД, лимиты скорости общие
+    :param workers: количество потоков
+    :param report: DispatchReport для сводки по рассылкам
+    :param limiter: RateLimiter, по умолчанию создаётся новый
+    """
+    limiter = limiter or RateLimiter()
+
+    def worker():
+        try:
+            with MailSender() as sender:
+                drain_outbox(sender, report, limiter, batch_size)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(worker) for _ in range(workers)]:
+            future.result()
@@ -0,0 +1,175 @@
+import datetime
+import smtplib
+import threading
+import time
+
+from django.utils import timezone
+
+import config.settings
+from mailing.models import MailingRateLimit
+from mailing.utils import PersonalizationError
+
+# код ответа SMTP, которым почтовый сервис сообщает о превышении лимитов (закрывает соединение).
+# Ответы 450/451/452 относятся к конкретному получателю (ящик переполнен или занят, грейлистинг)
+# и считаются обычной временной ошибкой
+THROTTLE_SMTP_CODES = (421,)
+
+
+def is_throttled(error):
+    """Проверяет, отклонил ли почтовый сервис письмо из-за превышения лимита отправки"""
+    if 'suspicion of SPAM' in str(error):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return any(code in THROTTLE_SMTP_CODES for code, _ in error.recipients.values())
+    return getattr(error, 'smtp_code', None) in THROTTLE_SMTP_CODES
+
+
+# ошибки, которые возникают до передачи адреса получателя (RCPT) и не зависят от него:
+# сервер недоступен или разорвал соединение, не прошла авторизация, отклонён адрес отправителя
+CONNECTION_ERRORS = (smtplib.SMTPConnectError, smtplib.SMTPHeloError, smtplib.SMTPAuthenticationError,
+                     smtplib.SMTPSenderRefused, smtplib.SMTPServerDisconnected, smtplib.SMTPNotSupportedError)
+
+
+def is_connection_error(error):
+    """
+    Проверяет, относится ли ошибка к соединению с почтовым сервером, а не к конкретному получателю.
+    Отказ из-за превышения лимитов (is_throttled) ошибкой соединения не считается, даже если пришёл на этапе MAIL FROM
+    """
+    if is_throttled(error):
+        return False
+    if isinstance(error, CONNECTION_ERRORS):
+        return True
+    # SMTPException - подкласс OSError, остальные OSError - сетевые ошибки (соединение отклонено, таймаут)
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def is_permanent(error):
+    """
+    Проверяет, окончательна ли ошибка отправки письма: сервер отказал в приёме письма получателю
+    (коды 5xx для всех адресов) или текст рассылки нельзя заполнить данными получателя
+    """
+    if isinstance(error, PersonalizationError):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return False
+
+
+class TokenBucket:
+    """
+    Ограничение скорости отправки "дырявым ведром": rate писем в секунду, всплеск до burst писем.
+    Скорость подстраивается по AIMD: после успешной отправки растёт на increase,
+    при отказе сервиса умножается на decrease, но не опускается ниже min_rate и не превышает исходную
+    """
+
+    def __init__(self, rate, burst, increase, decrease, min_rate):
+        self.max_rate = self.rate = rate
+        self.burst = self.tokens = burst
+        self.increase_step = increase
+        self.decrease_factor = decrease
+        self.min_rate = min_rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Забирает токен на отправку одного письма
+        :return: сколько секунд нужно подождать перед отправкой
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def increase(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def decrease(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.tokens = min(self.tokens, 0)
+
+    def restore(self, rate):
+        """Восстанавливает сниженную в прошлом запуске скорость, без начального всплеска"""
+        with self.lock:
+            self.rate = min(self.max_rate, max(self.min_rate, rate))
+            self.tokens = 0
+
+
+class RateLimiter:
+    """
+    Ограничение скорости отправки на каждый почтовый сервер и на каждого владельца рассылок
+    по настройкам EMAIL_RATE_LIMITS. Один объект используется всеми потоками отправки процесса.
+    Сниженная после отказов скорость сохраняется в БД (save) и восстанавливается в следующем запуске (load),
+    чтобы каждый запуск не начинал снова с полной скорости и всплеска
+    """
+
+    def __init__(self, limits=None, saved_rates=None):
+        self.limits = limits or config.settings.EMAIL_RATE_LIMITS
+        self.saved_rates = saved_rates or {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, limits=None):
+        """Ограничитель со скоростями, сохранёнными предыдущими запусками не раньше EMAIL_RATE_LIMITS['remember']"""
+        limits = limits or config.settings.EMAIL_RATE_LIMITS
+        since = timezone.now() - datetime.timedelta(seconds=limits['remember'])
+        saved_rates = {(kind, key): rate for kind, key, rate
+                       in MailingRateLimit.objects.filter(updated_at__gte=since).values_list('kind', 'key', 'rate')}
+        return cls(limits, saved_rates)
+
+    def save(self):
+        """
+        Сохраняет в БД сниженные скорости; для ограничений, скорость которых восстановилась до исходной,
+        сохранённые значения удаляются
+        """
+        now = timezone.now()
+        with self.lock:
+            buckets = list(self.buckets.items())
+        reduced = [MailingRateLimit(kind=kind, key=str(key), rate=bucket.rate, updated_at=now)
+                   for (kind, key), bucket in buckets if bucket.rate < bucket.max_rate]
+        restored = [(kind, str(key)) for (kind, key), bucket in buckets if bucket.rate >= bucket.max_rate]
+        if reduced:
+            MailingRateLimit.objects.bulk_create(reduced, update_conflicts=True, unique_fields=['kind', 'key'],
+                                                 update_fields=['rate', 'updated_at'])
+        for kind, key in restored:
+            if (kind, key) in self.saved_rates:
+                MailingRateLimit.objects.filter(kind=kind, key=key).delete()
+
+    def get_buckets(self, host, owner_id):
+        buckets = []
+        with self.lock:
+            for kind, key in (('host', host), ('owner', owner_id)):
+                if not self.limits[kind]['rate']:
+                    continue
+                if (kind, key) not in self.buckets:
+                    bucket = TokenBucket(
+                        rate=self.limits[kind]['rate'],
+                        burst=self.limits[kind]['burst'],
+                        increase=self.limits['increase'],
+                        decrease=self.limits['decrease'],
+                        min_rate=self.limits['min_rate'],
+                    )
+                    if (kind, str(key)) in self.saved_rates:
+                        bucket.restore(self.saved_rates[kind, str(key)])
+                    self.buckets[kind, key] = bucket
+                buckets.append(self.buckets[kind, key])
+        return buckets
+
+    def acquire(self, host, owner_id):
+        """Ждёт, пока лимиты сервера и владельца позволят отправить письмо"""
+        wait = max([bucket.take() for bucket in self.get_buckets(host, owner_id)], default=0)
+        if wait:
+            time.sleep(wait)
+
+    def feedback(self, host, owner_id, throttled):
+        """Подстраивает скорость по результату отправки письма"""
+        for bucket in self.get_buckets(host, owner_id):
+            if throttled:
+                bucket.decrease()
+            else:
+                bucket.increase()
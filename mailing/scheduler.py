@@ -0,0 +1,154 @@
+import datetime
+import heapq
+import select
+import time
+
+from django.db import connection
+from django.db.models import Min
+
+from mailing.models import MailingSettings, MailingOutbox
+
+# канал PostgreSQL LISTEN/NOTIFY для уведомлений планировщика об изменениях рассылок
+NOTIFY_CHANNEL = 'mailing_changes'
+# что изменилось: настройки рассылки или сама рассылка (в уведомлении передаётся вместе с id записи)
+CHANGED_SETTINGS = 'settings'
+CHANGED_MESSAGE = 'message'
+
+
+class DueQueue:
+    """
+    Мин-куча настроек рассылок по дате следующей отправки.
+    Устаревшие записи кучи не удаляются сразу, а пропускаются при чтении вершины
+    """
+
+    def __init__(self, shard=None):
+        self.heap = []
+        self.dates = {}
+        self.shard = shard
+
+    def __len__(self):
+        return len(self.dates)
+
+    def push(self, pk, next_sending_date):
+        self.dates[pk] = next_sending_date
+        heapq.heappush(self.heap, (next_sending_date, pk))
+
+    def peek(self):
+        """:return: ближайшая дата отправки или None, если отправлять нечего"""
+        while self.heap:
+            next_sending_date, pk = self.heap[0]
+            if self.dates.get(pk) == next_sending_date:
+                return next_sending_date
+            heapq.heappop(self.heap)
+        return None
+
+    def remove(self, pk):
+        """Убирает настройки из очереди (запись в куче будет пропущена при чтении вершины)"""
+        self.dates.pop(pk, None)
+
+    def get_settings(self):
+        """Незавершённые настройки опубликованных рассылок (своего шарда) с датой следующей отправки"""
+        settings = (MailingSettings.objects
+                    .filter(message__is_published=True, next_sending_date__isnull=False)
+                    .exclude(mailing_status=MailingSettings.STATUS.COMPLETED)
+                    .order_by())
+        return self.shard.filter(settings) if self.shard else settings
+
+    def load(self):
+        """Загружает из БД даты следующей отправки всех незавершённых опубликованных рассылок (своего шарда)"""
+        self.heap.clear()
+        self.dates.clear()
+        for pk, next_sending_date in self.get_settings().values_list('pk', 'next_sending_date'):
+            self.push(pk, next_sending_date)
+
+    def reload(self, settings_ids=(), message_ids=()):
+        """
+        Перечитывает из БД даты только изменившихся настроек: переданных и всех настроек переданных рассылок.
+        Настройки, которые больше не нужно отправлять (удалены, завершены, рассылка снята с публикации), убираются
+        """
+        changed = set(settings_ids)
+        if message_ids:
+            changed.update(MailingSettings.objects.filter(message_id__in=message_ids).values_list('pk', flat=True))
+        if not changed:
+            return
+        dates = dict(self.get_settings().filter(pk__in=changed).values_list('pk', 'next_sending_date'))
+        for pk in changed:
+            if pk in dates:
+                if self.dates.get(pk) != dates[pk]:
+                    self.push(pk, dates[pk])
+            else:
+                self.remove(pk)
+
+    def reload_due(self, date):
+        """Перечитывает даты настроек, отправка по которым была назначена не позже date (после запуска отправки)"""
+        self.reload(settings_ids=[pk for pk, next_sending_date in self.dates.items() if next_sending_date <= date])
+
+
+def get_next_retry_at():
+    """:return: ближайшее время повторной отправки писем из очереди или None"""
+    return MailingOutbox.objects.filter(
+        status__in=(MailingOutbox.STATUS.PENDING, MailingOutbox.STATUS.FAILED),
+        retry_at__isnull=False
+    ).aggregate(next_retry_at=Min('retry_at'))['next_retry_at']
+
+
+def notify_changes(kind, pk):
+    """
+    Отправляет планировщику уведомление об изменении рассылки или её настроек (только для PostgreSQL)
+    :param kind: CHANGED_SETTINGS или CHANGED_MESSAGE
+    :param pk: id изменённой записи
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [NOTIFY_CHANNEL, f'{kind}:{pk}'])
+
+
+def parse_changes(payloads):
+    """
+    Разбирает уведомления об изменениях рассылок
+    :param payloads: тексты уведомлений вида "settings:12", "message:5"
+    :return: пара множеств (id настроек, id рассылок) или None, если уведомление не распознано
+    и нужно перечитать все даты
+    """
+    changes = {CHANGED_SETTINGS: set(), CHANGED_MESSAGE: set()}
+    for payload in payloads:
+        kind, _, pk = payload.partition(':')
+        if kind not in changes or not pk.isdigit():
+            return None
+        changes[kind].add(int(pk))
+    return changes[CHANGED_SETTINGS], changes[CHANGED_MESSAGE]
+
+
+def listen_for_changes():
+    """
+    Подписывает текущее соединение с БД на уведомления об изменениях рассылок
+    :return: соединение psycopg2 или None, если БД не поддерживает LISTEN/NOTIFY
+    """
+    if connection.vendor != 'postgresql':
+        return None
+    connection.ensure_connection()
+    with connection.cursor() as cursor:
+        cursor.execute(f'LISTEN {NOTIFY_CHANNEL}')
+    return connection.connection
+
+
+def wait_for_changes(listener, timeout):
+    """
+    Ждёт уведомления об изменениях рассылок не дольше timeout секунд
+    :param listener: соединение, возвращённое listen_for_changes
+    :return: список текстов полученных уведомлений (пустой, если уведомлений не было)
+    """
+    if listener is None:
+        time.sleep(timeout)
+        return []
+    if not listener.notifies and select.select([listener], [], [], timeout) != ([], [], []):
+        listener.poll()
+    payloads = [notify.payload for notify in listener.notifies]
+    listener.notifies.clear()
+    return payloads
+
+
+def seconds_until(date):
+    """Количество секунд до начала суток date по локальному времени"""
+    wake_at = datetime.datetime.combine(date, datetime.time.min)
+    return max((wake_at - datetime.datetime.now()).total_seconds(), 0)
@@ -0,0 +1,100 @@
+import argparse
+import datetime
+import math
+import re
+import socket
+
+from django.db.models import F
+from django.db.models.functions import Coalesce, Mod
+from django.utils import timezone
+
+from config import settings
+from mailing.models import MailingNode
+
+# по какому ключу рассылки делятся между узлами
+SHARD_BY_MAILING = 'mailing'
+SHARD_BY_OWNER = 'owner'
+
+
+class Shard:
+    """
+    Часть рассылок, которую обрабатывает один узел: рассылки с (ключ % count) == index.
+    Ключ - id рассылки или id её владельца (тогда все рассылки пользователя отправляет один узел)
+    """
+
+    def __init__(self, index=0, count=1, key=SHARD_BY_MAILING):
+        if not 0 <= index < count:
+            raise ValueError(f'Номер шарда должен быть от 0 до {count - 1}')
+        self.index = index
+        self.count = count
+        self.key = key
+
+    def __str__(self):
+        return f'{self.index}/{self.count}'
+
+    @classmethod
+    def parse(cls, value):
+        """Разбор значения опции --shard вида K/N"""
+        match = re.fullmatch(r'(\d+)/(\d+)', value)
+        if not match:
+            raise argparse.ArgumentTypeError('Шард задаётся в виде K/N, например 0/3')
+        try:
+            return cls(int(match[1]), int(match[2]))
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
+    def filter(self, queryset, mailing_field='message'):
+        """
+        Оставляет в queryset только рассылки этого шарда
+        :param mailing_field: путь к рассылке в модели queryset
+        """
+        if self.count == 1:
+            return queryset
+        if self.key == SHARD_BY_OWNER:
+            key = Coalesce(F(f'{mailing_field}__owner'), 0)
+        else:
+            key = F(mailing_field)
+        return queryset.alias(shard_number=Mod(key, self.count)).filter(shard_number=self.index)
+
+    def is_same(self, node):
+        return (node.shard_index, node.shard_count, node.shard_key) == (self.index, self.count, self.key)
+
+    def intersects(self, node):
+        """
+        Могут ли одни и те же рассылки попасть и в этот шард, и в шард узла node.
+        При одном ключе остатки по модулям count и node.shard_count совместны, только если номера шардов
+        совпадают по модулю их НОД; при разных ключах (id рассылки и id владельца) пересечение возможно всегда
+        """
+        if node.shard_key != self.key:
+            return True
+        return (node.shard_index - self.index) % math.gcd(node.shard_count, self.count) == 0
+
+
+def register_node(shard, name=None):
+    """
+    Записывает в БД, какой шард обрабатывает текущий узел, и проверяет шарды других активных узлов
+    (запускавшихся за последние MAILING_NODE_TTL секунд)
+    Узлы с одинаковым шардом не мешают друг другу: запуски с одним шардом разделяют одну блокировку RunLock.
+    Предупреждение выводится, только если шард другого узла задан иначе, но пересекается с текущим
+    :return: список предупреждений о пересекающихся настройках шардов
+    """
+    name = name or settings.MAILING_NODE_NAME or socket.gethostname()
+    now = timezone.now()
+    MailingNode.objects.update_or_create(name=name, defaults={
+        'shard_index': shard.index,
+        'shard_count': shard.count,
+        'shard_key': shard.key,
+        'last_seen': now,
+    })
+    active_nodes = MailingNode.objects.filter(
+        last_seen__gte=now - datetime.timedelta(seconds=settings.MAILING_NODE_TTL)
+    ).exclude(name=name)
+
+    warnings = []
+    for node in active_nodes:
+        if not shard.is_same(node) and shard.intersects(node):
+            warnings.append(f'Шард узла {node.name} ({node.shard_index}/{node.shard_count} по {node.shard_key}) '
+                            f'пересекается с шардом {shard} по {shard.key}: общие рассылки оба узла ставят '
+                            f'в очередь независимо (повторные письма отбрасываются, но работа дублируется), '
+                            f'а часть рассылок может не попасть ни в один шард')
+    return warnings
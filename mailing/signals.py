@@ -0,0 +1,19 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from mailing.models import MailingMessage, MailingSettings
+from mailing.scheduler import notify_changes, CHANGED_MESSAGE, CHANGED_SETTINGS
+
+
+@receiver(post_save, sender=MailingMessage)
+@receiver(post_delete, sender=MailingMessage)
+def mailing_changed(sender, instance, **kwargs):
+    """Сообщает планировщику рассылок об изменении рассылки"""
+    notify_changes(CHANGED_MESSAGE, instance.pk)
+
+
+@receiver(post_save, sender=MailingSettings)
+@receiver(post_delete, sender=MailingSettings)
+def mailing_settings_changed(sender, instance, **kwargs):
+    """Сообщает планировщику рассылок об изменении настроек рассылки"""
+    notify_changes(CHANGED_SETTINGS, instance.pk)
@@ -0,0 +1,104 @@
+import datetime
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from mailing.models import MailingDailyStats, MailingLog, MailingMessage
+
+# статусы логов, которые учитываются в статистике: отложенные письма ещё будут отправлены или не отправлены
+DAILY_STATS_STATUSES = (MailingLog.STATUS.SUCCESS, MailingLog.STATUS.FAILED)
+
+
+def day_start(day):
+    """Начало дня day (полночь) в текущем часовом поясе"""
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min), timezone.get_current_timezone())
+
+
+def add_to_daily_stats(logs):
+    """
+    Добавляет записанные логи отправки писем к статистике по дням.
+    Учитываются только логи отправки отдельных писем (с получателем), сводки за запуск и отложенные письма
+    пропускаются. На каждую пару (рассылка, день, статус) - один UPDATE, количество запросов не зависит от числа логов
+    :param logs: сохранённые объекты MailingLog
+    """
+    counts = Counter((log.mailing_id, timezone.localdate(log.date), log.status)
+                     for log in logs
+                     if log.client_id and log.mailing_id and log.date and log.status in DAILY_STATS_STATUSES)
+    if not counts:
+        return
+    owners = dict(MailingMessage.objects.filter(pk__in={mailing_id for mailing_id, _, _ in counts})
+                  .values_list('pk', 'owner_id'))
+    for (mailing_id, day, status), count in counts.items():
+        stats = MailingDailyStats.objects.filter(mailing_id=mailing_id, day=day, status=status)
+        if stats.update(count=F('count') + count):
+            continue
+        try:
+            with transaction.atomic():
+                MailingDailyStats.objects.create(mailing_id=mailing_id, owner_id=owners.get(mailing_id),
+                                                 day=day, status=status, count=count)
+        except IntegrityError:
+            # строку успел создать параллельный процесс
+            stats.update(count=F('count') + count)
+
+
+def backfill_daily_stats(since=None, until=None):
+    """
+    Пересчитывает статистику по дням из логов отправки писем за дни с since по until включительно.
+    По умолчанию - с дня самого старого лога до сегодня; статистика за более ранние дни,
+    логи которых уже удалены, сохраняется. Если статистика за день самого старого лога уже есть,
+    этот день не пересчитывается: его логи могли быть удалены не полностью
+    :return: количество записей статистики
+    """
+    logs = MailingLog.objects.filter(client__isnull=False, mailing__isnull=False, date__isnull=False,
+                                     status__in=DAILY_STATS_STATUSES)
+    if since is None:
+        oldest = logs.order_by('date').values_list('date', flat=True).first()
+        if oldest is None:
+            return 0
+        since = timezone.localdate(oldest)
+        if MailingDailyStats.objects.filter(day=since).exists():
+            since += datetime.timedelta(days=1)
+    until = until or timezone.localdate()
+    tz = timezone.get_current_timezone()
+    start = day_start(since)
+    end = day_start(until + datetime.timedelta(days=1))
+
+    rows = (logs.filter(date__gte=start, date__lt=end)
+            .annotate(day=TruncDate('date', tzinfo=tz))
+            .values('mailing_id', 'mailing__owner_id', 'day', 'status')
+            .annotate(count=Count('pk'))
+            .order_by())
+    with transaction.atomic():
+        MailingDailyStats.objects.filter(day__gte=since, day__lte=until).delete()
+        stats = MailingDailyStats.objects.bulk_create(
+            [MailingDailyStats(mailing_id=row['mailing_id'], owner_id=row['mailing__owner_id'],
+                               day=row['day'], status=row['status'], count=row['count']) for row in rows],
+            batch_size=1000
+        )
+    return len(stats)
+
+
+def get_delivery_report(mailing_id, days=30):
+    """
+    Отчёт об отправке писем рассылки из статистики по дням
+    :param days: за сколько последних дней выводить разбивку по дням
+    :return: словарь с итогами за всё время и списком дней с количеством отправленных и неотправленных писем
+    """
+    stats = MailingDailyStats.objects.filter(mailing_id=mailing_id)
+    totals = dict(stats.values_list('status').annotate(total=Sum('count')).order_by())
+
+    by_day = {}
+    since = timezone.localdate() - datetime.timedelta(days=days - 1)
+    for day, status, count in stats.filter(day__gte=since).values_list('day', 'status', 'count'):
+        by_day.setdefault(day, Counter())[status] += count
+    return {
+        'sent': totals.get(MailingLog.STATUS.SUCCESS, 0),
+        'failed': totals.get(MailingLog.STATUS.FAILED, 0),
+        'days': [{'day': day,
+                  'sent': counts[MailingLog.STATUS.SUCCESS],
+                  'failed': counts[MailingLog.STATUS.FAILED]}
+                 for day, counts in sorted(by_day.items(), reverse=True)],
+    }
@@ -0,0 +1,354 @@
+import datetime
+import io
+import smtplib
+from unittest import mock
+
+from django.core import mail as django_mail
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import config.settings
+from clients.models import Client
+from mailing.forms import MailingForm
+from mailing.loadtest import RealMailError, run_benchmark, seed_load
+from mailing.models import MailingDailyStats, MailingLog, MailingMessage, MailingNode, MailingSettings, MailingOutbox
+from mailing.outbox import DispatchReport, claim_batch, complete_batch, enqueue_mailing, send_batch
+from mailing.sharding import Shard, SHARD_BY_OWNER, register_node
+from mailing.stats import add_to_daily_stats, backfill_daily_stats, day_start, get_delivery_report
+from mailing.utils import MailSender, advance_sending_dates, get_mail_prepared
+from users.models import User
+
+
+class GetMailPreparedTestCase(TestCase):
+    """Запуск и завершение рассылок выполняются одним запросом UPDATE независимо от количества рассылок"""
+
+    def setUp(self):
+        self.owner = User.objects.create(email='owner@test.ru', is_active=True)
+        self.today = datetime.date.today()
+
+    def create_mailings(self, count):
+        """Создаёт count рассылок, которые нужно запустить, и count рассылок, которые нужно завершить"""
+        week = datetime.timedelta(days=7)
+        for i in range(count):
+            to_start = MailingMessage.objects.create(subject=f'Новая {i}', body='текст', owner=self.owner)
+            MailingSettings.objects.create(message=to_start, mailing_start=self.today - week,
+                                           mailing_end=self.today + week,
+                                           mailing_period=MailingSettings.FREQUENCY.DAILY)
+            to_complete = MailingMessage.objects.create(subject=f'Истёкшая {i}', body='текст', owner=self.owner)
+            MailingSettings.objects.create(message=to_complete, mailing_start=self.today - week * 2,
+                                           mailing_end=self.today - week,
+                                           mailing_period=MailingSettings.FREQUENCY.DAILY,
+                                           mailing_status=MailingSettings.STATUS.RUNNING)
+
+    def assert_constant_queries(self, count):
+        self.create_mailings(count)
+        # два UPDATE (запуск и завершение) и один SELECT запущенных рассылок
+        with self.assertNumQueries(3):
+            running = list(get_mail_prepared(self.today))
+        self.assertEqual(len(running), count)
+        self.assertEqual(MailingSettings.objects.filter(mailing_status=MailingSettings.STATUS.COMPLETED).count(),
+                         count)
+
+    def test_queries_few_mailings(self):
+        self.assert_constant_queries(2)
+
+    def test_queries_many_mailings(self):
+        self.assert_constant_queries(100)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class PersonalizationTestCase(TestCase):
+    """Ошибки в тегах персонализации отклоняются при сохранении, а при отправке ломают только свои письма"""
+
+    def setUp(self):
+        self.owner = User.objects.create(email='owner@test.ru', is_active=True)
+        self.client_a = Client.objects.create(email='a@test.ru', name='Анна', owner=self.owner)
+        self.client_b = Client.objects.create(email='b@test.ru', name='Борис', owner=self.owner)
+
+    def get_form(self, body):
+        return MailingForm(data={'subject': 'Тема', 'body': body, 'recipient': [self.client_a.pk]}, user=self.owner)
+
+    def test_form_accepts_client_fields(self):
+        form = self.get_form('Здравствуйте, {{ client.name|upper }}! {% if client.comment %}{{ client.comment }}{% endif %}')
+        self.assertNotIn('body', form.errors)
+
+    def test_form_rejects_forbidden_tags(self):
+        for body in ("{% url 'mailing:view_all' %}", "{% include 'base.html' %}", '{% load static %}'):
+            with self.subTest(body=body):
+                self.assertIn('body', self.get_form(body).errors)
+
+    def test_form_rejects_padding_filters(self):
+        # ширина не вызывает переполнения, но заняла бы сотни мегабайт при проверке и при каждой отправке
+        for body in ('{{ client.name|center:"300000000" }}', '{{ client.name|ljust:"300000000" }}',
+                     '{{ client.name|rjust:"300000000" }}', '{{ client.name|stringformat:"300000000s" }}',
+                     '{% lorem 300000000 w %}'):
+            with self.subTest(body=body):
+                self.assertIn('body', self.get_form(body).errors)
+
+    def test_form_rejects_render_errors(self):
+        self.assertIn('body', self.get_form('{{ client.name|divisibleby:"0" }}').errors)
+
+    def test_bad_body_fails_only_its_rows(self):
+        today = datetime.date.today()
+        bad = MailingMessage.objects.create(subject='Плохая', body="{% url 'нет' %}", owner=self.owner)
+        good = MailingMessage.objects.create(subject='Хорошая', body='Привет, {{ client.name }}', owner=self.owner)
+        for mail in (bad, good):
+            mail.recipient.set([self.client_a, self.client_b])
+            enqueue_mailing(mail, today)
+        with MailSender() as sender:
+            sent, failed, _ = send_batch(sender, claim_batch())
+        complete_batch(sent, failed)
+        self.assertEqual(set(MailingOutbox.objects.filter(mailing=bad).values_list('status', flat=True)),
+                         {MailingOutbox.STATUS.DEAD})
+        self.assertEqual(set(MailingOutbox.objects.filter(mailing=good).values_list('status', flat=True)),
+                         {MailingOutbox.STATUS.SENT})
+
+
+class ClaimBatchTestCase(TestCase):
+    """Пакет писем забирается из очереди постоянным числом запросов, рассылка загружается один раз на пакет"""
+
+    def setUp(self):
+        self.owner = User.objects.create(email='owner@test.ru', is_active=True)
+        self.today = datetime.date.today()
+
+    def enqueue(self, clients):
+        mail = MailingMessage.objects.create(subject='Тема', body='Привет, {{ client.name }}', owner=self.owner)
+        mail.recipient.set(Client.objects.bulk_create(
+            [Client(email=f'client{i}@test.ru', name=f'Клиент {i}', owner=self.owner) for i in range(clients)]
+        ))
+        enqueue_mailing(mail, self.today)
+
+    def assert_constant_queries(self, clients):
+        self.enqueue(clients)
+        # SELECT ... FOR UPDATE строк с получателями, UPDATE статуса, SELECT рассылок пакета
+        # и SAVEPOINT/RELEASE транзакции claim_batch внутри транзакции теста
+        with self.assertNumQueries(5):
+            rows = claim_batch(batch_size=clients)
+            for row in rows:
+                (row.mailing.subject, row.mailing.body, row.mailing.owner_id,
+                 row.client.email, row.client.name, row.client.comment, row.attempts, row.deferrals)
+        self.assertEqual(len(rows), clients)
+        self.assertEqual(len({id(row.mailing) for row in rows}), 1)
+
+    def test_queries_small_batch(self):
+        self.assert_constant_queries(2)
+
+    def test_queries_large_batch(self):
+        self.assert_constant_queries(50)
+
+
+class LoadTestGuardTestCase(TestCase):
+    """Нагрузочный тест отказывается запускаться, если отправил бы настоящие письма"""
+
+    def setUp(self):
+        self.today = datetime.date.today()
+        seed_load(users=1, clients_per_user=3, mailings_per_user=2, seed=1)
+        owner = User.objects.create(email='owner@test.ru', is_active=True)
+        self.mail = MailingMessage.objects.create(subject='Настоящая', body='текст', owner=owner, is_published=True)
+        self.settings = MailingSettings.objects.create(message=self.mail, mailing_start=self.today,
+                                                       mailing_end=self.today + datetime.timedelta(days=7),
+                                                       mailing_period=MailingSettings.FREQUENCY.DAILY,
+                                                       next_sending_date=self.today)
+
+    def test_refuses_due_real_mailing(self):
+        with self.assertRaises(RealMailError):
+            run_benchmark()
+        self.settings.refresh_from_db()
+        self.assertEqual(self.settings.mailing_status, MailingSettings.STATUS.CREATED)
+        self.assertEqual(self.settings.next_sending_date, self.today)
+
+    def test_refuses_queued_real_mail(self):
+        self.settings.next_sending_date = self.today + datetime.timedelta(days=1)
+        self.settings.save()
+        self.mail.recipient.set([Client.objects.create(email='real@test.ru', name='Клиент')])
+        enqueue_mailing(self.mail, self.today)
+        with self.assertRaises(RealMailError):
+            run_benchmark()
+        self.assertFalse(MailingOutbox.objects.filter(mailing=self.mail, status=MailingOutbox.STATUS.SENT).exists())
+
+    def test_runs_without_real_mail(self):
+        self.settings.next_sending_date = self.today + datetime.timedelta(days=1)
+        self.settings.save()
+        # assertLogs перехватывает сообщения о блокировке запуска, чтобы они не выводились в консоль
+        with self.assertLogs('mailing', 'INFO') as logs:
+            self.assertGreater(run_benchmark()['messages'], 0)
+        self.assertIn('Блокировка запуска getmail:mailing:0/1 снята', logs.output[-1])
+
+
+class DailyStatsTestCase(TestCase):
+    """Статистика по дням не учитывает отложенные письма и не занижается после удаления старых логов"""
+
+    def setUp(self):
+        owner = User.objects.create(email='owner@test.ru', is_active=True)
+        self.mail = MailingMessage.objects.create(subject='Тема', body='текст', owner=owner)
+        self.recipient = Client.objects.create(email='a@test.ru', name='Анна', owner=owner)
+        self.today = timezone.localdate()
+
+    def create_logs(self, status, date, count=1):
+        logs = MailingLog.objects.bulk_create([MailingLog(status=status, date=date, mailing=self.mail,
+                                                          client=self.recipient) for _ in range(count)])
+        add_to_daily_stats(logs)
+
+    def test_deferred_logs_are_not_failed(self):
+        now = timezone.now()
+        self.create_logs(MailingLog.STATUS.SUCCESS, now, 3)
+        self.create_logs(MailingLog.STATUS.FAILED, now, 1)
+        self.create_logs(MailingLog.STATUS.DEFERRED, now, 5)
+        for _ in range(2):
+            report = get_delivery_report(self.mail.pk)
+            self.assertEqual((report['sent'], report['failed']), (3, 1))
+            backfill_daily_stats()
+
+    def test_prune_keeps_whole_days(self):
+        days_ago = 3
+        boundary = self.today - datetime.timedelta(days=days_ago)
+        self.create_logs(MailingLog.STATUS.SUCCESS, day_start(boundary) - datetime.timedelta(hours=1), 2)
+        self.create_logs(MailingLog.STATUS.SUCCESS, day_start(boundary) + datetime.timedelta(minutes=1), 4)
+        self.create_logs(MailingLog.STATUS.SUCCESS, day_start(boundary) + datetime.timedelta(hours=23), 1)
+        call_command('prune_mailing_logs', older_than=days_ago, stdout=io.StringIO())
+        self.assertEqual(MailingLog.objects.count(), 5)
+        backfill_daily_stats()
+        self.assertEqual(MailingDailyStats.objects.get(day=boundary).count, 5)
+        self.assertEqual(MailingDailyStats.objects.get(day=boundary - datetime.timedelta(days=1)).count, 2)
+
+    def test_backfill_skips_partially_pruned_day(self):
+        yesterday = self.today - datetime.timedelta(days=1)
+        self.create_logs(MailingLog.STATUS.SUCCESS, day_start(yesterday) + datetime.timedelta(hours=1), 3)
+        self.create_logs(MailingLog.STATUS.SUCCESS, day_start(yesterday) + datetime.timedelta(hours=20), 2)
+        # логи удалены не с полуночи: часть дня осталась
+        MailingLog.objects.filter(date__lt=day_start(yesterday) + datetime.timedelta(hours=2)).delete()
+        backfill_daily_stats()
+        self.assertEqual(MailingDailyStats.objects.get(day=yesterday).count, 5)
+
+
+class MailingListViewTestCase(TestCase):
+    """Количество запросов страницы списка рассылок не зависит от количества рассылок на странице"""
+
+    def setUp(self):
+        self.owner = User.objects.create(email='owner@test.ru', is_active=True)
+        self.client.force_login(self.owner)
+        self.today = datetime.date.today()
+
+    def create_mailings(self, count):
+        for i in range(count):
+            mail = MailingMessage.objects.create(subject=f'Рассылка {i}', body='текст', owner=self.owner)
+            MailingSettings.objects.create(message=mail, mailing_start=self.today,
+                                           mailing_end=self.today + datetime.timedelta(days=7),
+                                           mailing_period=MailingSettings.FREQUENCY.WEEKLY)
+
+    def get_list(self):
+        response = self.client.get(reverse('mailing:mailing_list'))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_queries_do_not_depend_on_page_size(self):
+        self.create_mailings(3)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_list()
+        self.assertEqual(len(response.context['object_list']), 3)
+        self.create_mailings(47)
+        with self.assertNumQueries(len(queries)):
+            response = self.get_list()
+        self.assertEqual(len(response.context['object_list']), 50)
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class AsyncGetmailTestCase(TransactionTestCase):
+    """
+    getmail --async разбирает очередь несколькими одновременными пакетами через локальный почтовый бэкенд.
+    TransactionTestCase: запросы к БД из sync_to_async выполняются в другом потоке и должны видеть данные теста
+    """
+
+    def setUp(self):
+        today = datetime.date.today()
+        owner = User.objects.create(email='owner@test.ru', is_active=True)
+        self.mail = MailingMessage.objects.create(subject='Тема', body='Привет, {{ client.name }}', owner=owner,
+                                                  is_published=True)
+        self.mail.recipient.set(Client.objects.bulk_create(
+            [Client(email=f'client{i}@test.ru', name=f'Клиент {i}', owner=owner) for i in range(7)]
+        ))
+        MailingSettings.objects.create(message=self.mail, mailing_start=today,
+                                       mailing_end=today + datetime.timedelta(days=7),
+                                       mailing_period=MailingSettings.FREQUENCY.DAILY, next_sending_date=today)
+
+    def test_dispatch(self):
+        # пакеты по 2 письма: 4 пакета отправляются одновременно в 3 потоках
+        with mock.patch.object(config.settings, 'EMAIL_BATCH_SIZE', 2):
+            with self.assertLogs('mailing', 'INFO'):
+                call_command('getmail', use_async=True, concurrency=3, stdout=io.StringIO())
+
+        self.assertEqual(len(django_mail.outbox), 7)
+        self.assertEqual(sorted(message.to[0] for message in django_mail.outbox),
+                         sorted(self.mail.recipient.values_list('email', flat=True)))
+        self.assertEqual(set(MailingOutbox.objects.filter(mailing=self.mail).values_list('status', flat=True)),
+                         {MailingOutbox.STATUS.SENT})
+        logs = MailingLog.objects.filter(mailing=self.mail)
+        self.assertEqual(logs.filter(client__isnull=False, status=MailingLog.STATUS.SUCCESS).count(), 7)
+        self.assertEqual(logs.filter(client__isnull=True, status=MailingLog.STATUS.SUCCESS).count(), 1)
+
+
+class RegisterNodeTestCase(TestCase):
+    """Предупреждение выводится только для шардов других узлов, которые заданы иначе и пересекаются с текущим"""
+
+    def add_node(self, name, index, count, key='mailing'):
+        MailingNode.objects.create(name=name, shard_index=index, shard_count=count, shard_key=key,
+                                   last_seen=timezone.now())
+
+    def test_warnings(self):
+        self.add_node('same', 0, 2)
+        self.add_node('other-half', 1, 2)
+        self.add_node('disjoint', 1, 4)
+        self.add_node('intersecting', 2, 4)
+        self.add_node('by-owner', 1, 2, SHARD_BY_OWNER)
+        warnings = register_node(Shard(0, 2), name='current')
+        # узел с тем же шардом ждёт ту же блокировку запуска, 1/2 и 1/4 не пересекаются с 0/2
+        self.assertEqual(sorted(warning.split()[2] for warning in warnings), ['by-owner', 'intersecting'])
+
+
+class AdvanceSendingDatesTestCase(TestCase):
+    """Даты следующей отправки всех настроек, отправленных за запуск, записываются одним UPDATE"""
+
+    def test_single_update(self):
+        owner = User.objects.create(email='owner@test.ru', is_active=True)
+        today = datetime.date.today()
+        for i in range(150):
+            mail = MailingMessage.objects.create(subject=f'Рассылка {i}', body='текст', owner=owner)
+            MailingSettings.objects.create(message=mail, mailing_start=today,
+                                           mailing_end=today + datetime.timedelta(days=30),
+                                           mailing_period=MailingSettings.FREQUENCY.DAILY,
+                                           mailing_status=MailingSettings.STATUS.RUNNING, next_sending_date=today)
+        # SELECT настроек и один UPDATE ... CASE WHEN
+        with self.assertNumQueries(2):
+            self.assertEqual(advance_sending_dates(MailingSettings.objects.all()), 150)
+        self.assertFalse(MailingSettings.objects.filter(next_sending_date=today).exists())
+
+
+class ConnectionErrorTestCase(TestCase):
+    """Письма, не отправленные из-за ошибки соединения, откладываются со случайной задержкой и считаются отложенными"""
+
+    def test_deferred_with_jitter(self):
+        owner = User.objects.create(email='owner@test.ru', is_active=True)
+        mail = MailingMessage.objects.create(subject='Тема', body='текст', owner=owner)
+        mail.recipient.set(Client.objects.bulk_create(
+            [Client(email=f'client{i}@test.ru', name=f'Клиент {i}', owner=owner) for i in range(20)]
+        ))
+        enqueue_mailing(mail, datetime.date.today())
+        error = smtplib.SMTPAuthenticationError(535, b'authentication failed')
+        failed = [(row, error) for row in claim_batch()]
+        started = timezone.now()
+        complete_batch([], failed)
+        report = DispatchReport()
+        report.add([], failed, 0)
+
+        rows = MailingOutbox.objects.filter(mailing=mail)
+        self.assertEqual(set(rows.values_list('status', 'attempts')), {(MailingOutbox.STATUS.PENDING, 0)})
+        base_delay = config.settings.EMAIL_RETRY['base_delay']
+        retry_delays = [(retry_at - started).total_seconds() for retry_at in rows.values_list('retry_at', flat=True)]
+        self.assertTrue(all(base_delay / 2 - 1 <= delay <= base_delay + 1 for delay in retry_delays))
+        self.assertGreater(len(set(retry_delays)), 1)
+        result = report.mailings[mail.pk]
+        self.assertEqual((result['deferred'], result['failed'], result['error']), (20, 0, None))
@@ -11,4 +11,5 @@ urlpatterns = [
     path('delete/<int:pk>/', MailingDeleteView.as_view(), name='delete_mailing'),
     path('view_all/', MailingListView.as_view(), name='mailing_list'),
     path('view_details/<int:pk>/', MailingDetailView.as_view(), name='mailing_details'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
@@ -1,40 +1,97 @@
-from django.core.mail import send_mail
+import re
+import smtplib
+import time
+from email.utils import formatdate
+from functools import lru_cache
+from itertools import islice
+
+from django.conf import settings as django_settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.message import make_msgid, sanitize_address, DNS_NAME
+from django.template import Context, Engine, Library, TemplateSyntaxError
 
 import config.settings
-from mailing.models import MailingMessage, MailingSettings
+from mailing.metrics import metrics
+from mailing.models import MailingMessage, MailingSettings, MailingLog
+
+# теги, недоступные в тексте рассылки: обращаются к шаблонам, URL и библиотекам тегов проекта
+# и при отправке писем падали бы с ошибкой, которую не видно при компиляции текста
+PERSONALIZATION_FORBIDDEN_TAGS = frozenset({
+    'load', 'url', 'include', 'extends', 'block', 'csrf_token', 'debug',
+    # генерирует текст произвольной длины
+    'lorem',
+})
+# фильтры, дополняющие значение до заданной ширины: {{ client.name|center:"999999999" }} занимает гигабайт памяти
+# при проверке текста и при отправке каждому получателю
+PERSONALIZATION_FORBIDDEN_FILTERS = frozenset({'center', 'ljust', 'rjust', 'stringformat'})
+# данные получателя для проверки текста рассылки при сохранении
+SAMPLE_CLIENT_CONTEXT = {'name': 'Иван Иванов', 'email': 'client@example.com', 'comment': 'комментарий'}
+
+
+class PersonalizationError(Exception):
+    """Ошибка в тегах персонализации текста рассылки: письмо нельзя собрать ни для одного получателя"""
+
+
+def get_personalization_engine():
+    """
+    Шаблонизатор для персонализации текста писем: без загрузчиков шаблонов, без экранирования HTML
+    (текст писем простой), без тегов из PERSONALIZATION_FORBIDDEN_TAGS и фильтров из PERSONALIZATION_FORBIDDEN_FILTERS
+    """
+    engine = Engine(autoescape=False)
+    restricted = []
+    for library in engine.template_builtins:
+        copy = Library()
+        copy.filters = {name: filter_func for name, filter_func in library.filters.items()
+                        if name not in PERSONALIZATION_FORBIDDEN_FILTERS}
+        copy.tags = {name: tag for name, tag in library.tags.items() if name not in PERSONALIZATION_FORBIDDEN_TAGS}
+        restricted.append(copy)
+    engine.template_builtins = restricted
+    return engine
+
+
+PERSONALIZATION_ENGINE = get_personalization_engine()
+
+# что делать с рассылками, дата отправки которых пропущена
+CATCH_UP_SEND = 'send'
+CATCH_UP_SKIP = 'skip'
+
 
+def start_mailings(current_date):
+    """
+    Переводит в статус "запущена" настройки опубликованных рассылок в статусе "создана",
+    у которых дата начала меньше и дата окончания больше текущей. Выполняется одним запросом UPDATE
+    :return: количество изменённых настроек
+    """
+    return MailingSettings.objects.filter(message__is_published=True,
+                                          mailing_status=MailingSettings.STATUS.CREATED,
+                                          mailing_start__lte=current_date,
+                                          mailing_end__gte=current_date).update(
+        mailing_status=MailingSettings.STATUS.RUNNING
+    )
+
+
+def complete_mailings(current_date):
+    """
+    Переводит в статус "завершена" настройки опубликованных рассылок в статусе "запущена",
+    у которых дата окончания меньше текущей. Выполняется одним запросом UPDATE
+    :return: количество изменённых настроек
+    """
+    return MailingSettings.objects.filter(message__is_published=True,
+                                          mailing_status=MailingSettings.STATUS.RUNNING,
+                                          mailing_end__lt=current_date).update(
+        mailing_status=MailingSettings.STATUS.COMPLETED
+    )
 
+
+@metrics.timed('mailing_prepare_seconds')
 def get_mail_prepared(current_date):
     """
-    Функция для подготовки рассылок
+    Функция для подготовки рассылок: запускает новые и завершает истёкшие рассылки.
+    Количество запросов к БД не зависит от количества рассылок
     :return: все опубликованные рассылки со статусом "запущена"
     """
-    # получаем рассылки, у которых дата начала меньше и дата окончания больше текущей и статус "создана"
-    new_mail = MailingMessage.objects.filter(is_published=True,
-                                             setting__mailing_status=MailingSettings.STATUS.CREATED,
-                                             setting__mailing_start__lte=current_date,
-                                             setting__mailing_end__gte=current_date)
-
-    # получаем рассылки, у которых дата окончания меньше текущей и статус "запущена"
-    old_mail = MailingMessage.objects.filter(is_published=True,
-                                             setting__mailing_status=MailingSettings.STATUS.RUNNING,
-                                             setting__mailing_end__lt=current_date)
-
-    # запускаем новые рассылки, у которых дата начала меньше и дата окончания больше текущей
-    if new_mail.exists():
-        for letter in new_mail:
-            settings = letter.settings.filter(message_id=letter.pk)
-            for setting in settings:
-                setting.mailing_status = MailingSettings.STATUS.RUNNING
-                setting.save()
-
-    # завершаем рассылки, у которых дата окончания меньше текущей
-    if old_mail.exists():
-        for letter in old_mail:
-            settings = letter.settings.filter(message_id=letter.pk)
-            for setting in settings:
-                setting.mailing_status = MailingSettings.STATUS.COMPLETED
-                setting.save()
+    start_mailings(current_date)
+    complete_mailings(current_date)
 
     # получаем все рассылки со статусом "запущена"
     running_mail = MailingMessage.objects.filter(is_published=True,
@@ -43,6 +100,71 @@ def get_mail_prepared(current_date):
     return running_mail
 
 
+def get_due_settings(current_date, shard=None):
+    """
+    Функция для получения настроек запущенных опубликованных рассылок, отправка по которым назначена на текущую дату
+    :param shard: только рассылки этого шарда (mailing.sharding.Shard)
+    """
+    settings = MailingSettings.objects.filter(message__is_published=True,
+                                              mailing_status=MailingSettings.STATUS.RUNNING,
+                                              next_sending_date=current_date)
+    return shard.filter(settings) if shard else settings
+
+
+def advance_sending_dates(settings):
+    """
+    Устанавливает дату следующей отправки для всех переданных настроек рассылок.
+    Настройки без периодичности отправляются один раз и завершаются.
+    Даты считаются в Python, а записываются одним запросом bulk_update (UPDATE ... CASE WHEN);
+    на несколько запросов Django делит его, только если строк больше, чем позволяет лимит параметров БД
+    :param settings: queryset настроек рассылок, отправленных в текущем запуске
+    :return: количество изменённых настроек
+    """
+    settings = list(settings.only('pk', 'mailing_start', 'mailing_period', 'next_sending_date', 'mailing_status'))
+    for setting in settings:
+        if setting.mailing_period:
+            setting.next_sending_date = setting.get_next_sending_date()
+        else:
+            setting.mailing_status = MailingSettings.STATUS.COMPLETED
+    return MailingSettings.objects.bulk_update(settings, ['next_sending_date', 'mailing_status'])
+
+
+def get_overdue_settings(current_date, shard=None):
+    """
+    Функция для получения настроек запущенных опубликованных рассылок с пропущенной датой отправки
+    (например, если отправка не запускалась несколько дней)
+    :param shard: только рассылки этого шарда (mailing.sharding.Shard)
+    """
+    settings = MailingSettings.objects.filter(message__is_published=True,
+                                              mailing_status=MailingSettings.STATUS.RUNNING,
+                                              next_sending_date__lt=current_date)
+    return shard.filter(settings) if shard else settings
+
+
+def catch_up_sending_dates(current_date, policy=None, shard=None):
+    """
+    Переносит пропущенные даты отправки на ближайшую дату по расписанию, не раньше текущей.
+    Настройки без периодичности завершаются. Изменения записываются одним запросом bulk_update
+    :param policy: CATCH_UP_SEND - отправить пропущенные рассылки один раз сейчас,
+    CATCH_UP_SKIP - только перенести даты; по умолчанию MAILING_CATCH_UP_POLICY
+    :param shard: только рассылки этого шарда (mailing.sharding.Shard)
+    :return: множество id рассылок, которые нужно отправить сейчас
+    """
+    policy = policy or config.settings.MAILING_CATCH_UP_POLICY
+    overdue = list(get_overdue_settings(current_date, shard).only(
+        'pk', 'message_id', 'mailing_start', 'mailing_period', 'next_sending_date', 'mailing_status'
+    ))
+    for setting in overdue:
+        if setting.mailing_period:
+            setting.next_sending_date = setting.get_sending_date_on_or_after(current_date)
+        else:
+            setting.mailing_status = MailingSettings.STATUS.COMPLETED
+    MailingSettings.objects.bulk_update(overdue, ['next_sending_date', 'mailing_status'])
+    if policy == CATCH_UP_SEND:
+        return {setting.message_id for setting in overdue}
+    return set()
+
+
 def get_current_mail_for_sending_in_period(current_date, mail_queryset, frequency):
     current_mail_for_sending_in_period = mail_queryset.filter(setting__mailing_period=frequency,
                                                               setting__next_sending_date=current_date)
@@ -50,15 +172,244 @@ def get_current_mail_for_sending_in_period(current_date, mail_queryset, frequenc
     return current_mail_for_sending_in_period
 
 
-def send_ready_mail(all_mail):
+class MailSender:
+    """
+    Отправка писем через одно переиспользуемое SMTP-соединение.
+    Соединение открывается один раз на запуск и переоткрывается после
+    EMAIL_MESSAGES_PER_CONNECTION писем или при обрыве связи сервером
+    """
+
+    def __init__(self, connection=None, messages_per_connection=None):
+        self.connection = connection or get_connection()
+        self.messages_per_connection = (messages_per_connection
+                                        or config.settings.EMAIL_MESSAGES_PER_CONNECTION)
+        self.sent_in_connection = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.close()
+
+    def open(self):
+        """Открывает соединение, если оно ещё не открыто"""
+        started = time.monotonic()
+        if self.connection.open():
+            metrics.observe('mailing_smtp_connect_seconds', time.monotonic() - started)
+
+    def reconnect(self):
+        """Закрывает текущее соединение и открывает новое"""
+        self.connection.close()
+        self.open()
+        self.sent_in_connection = 0
+
+    def send_message(self, message):
+        """
+        Отправка одного письма через открытое соединение.
+        Если сервер разорвал соединение, переподключаемся и повторяем отправку один раз
+        :return: количество отправленных писем
+        """
+        if self.messages_per_connection and self.sent_in_connection >= self.messages_per_connection:
+            self.reconnect()
+        # соединение открывается при первой отправке, чтобы ошибки авторизации попадали в лог рассылки
+        self.open()
+        with metrics.timer('mailing_smtp_send_seconds'):
+            try:
+                sent = self.connection.send_messages([message])
+            except smtplib.SMTPServerDisconnected:
+                self.reconnect()
+                sent = self.connection.send_messages([message])
+        self.sent_in_connection += sent
+        return sent
+
+
+class MessageTemplate:
+    """
+    Письмо рассылки, собранное и закодированное в MIME один раз.
+    Для каждого получателя в готовые байты подставляются только заголовки To, Date и Message-ID
+    """
+    TO = 'recipient@placeholder.invalid'
+    DATE = 'date.placeholder.invalid'
+    MESSAGE_ID = '<message-id@placeholder.invalid>'
+    PLACEHOLDERS = re.compile(b'(' + b'|'.join(re.escape(value.encode()) for value in (TO, DATE, MESSAGE_ID)) + b')')
+
+    def __init__(self, subject, body, from_email):
+        self.subject = subject
+        self.body = body
+        self.from_email = from_email
+        self.mime = EmailMessage(subject=subject, body=body, from_email=from_email, to=[self.TO],
+                                 headers={'Date': self.DATE, 'Message-ID': self.MESSAGE_ID}).message()
+        self.encoding = self.mime.encoding
+        self.parts = {}
+
+    def get_parts(self, linesep):
+        """Готовое письмо, разрезанное по подставляемым заголовкам, отдельно для каждого разделителя строк"""
+        if linesep not in self.parts:
+            self.parts[linesep] = self.PLACEHOLDERS.split(self.mime.as_bytes(linesep=linesep))
+        return self.parts[linesep]
+
+    def render(self, email, linesep):
+        """
+        Письмо получателю в виде байтов
+        :param email: адрес получателя
+        :param linesep: разделитель строк, который запросил почтовый бэкенд
+        """
+        values = {
+            self.TO.encode(): sanitize_address(email, self.encoding).encode(),
+            self.DATE.encode(): formatdate(localtime=django_settings.EMAIL_USE_LOCALTIME).encode(),
+            self.MESSAGE_ID.encode(): make_msgid(domain=DNS_NAME).encode(),
+        }
+        return b''.join(values.get(part, part) for part in self.get_parts(linesep))
+
+
+class PreparedMIME:
+    """Объект, который почтовые бэкенды Django получают из EmailMessage.message(), на основе MessageTemplate"""
+
+    def __init__(self, template, email):
+        self.template = template
+        self.email = email
+
+    def as_bytes(self, unixfrom=False, linesep='\n'):
+        return self.template.render(self.email, linesep)
+
+    def as_string(self, unixfrom=False, linesep='\n'):
+        return self.as_bytes(unixfrom, linesep).decode(self.template.encoding)
+
+    def get_charset(self):
+        return self.template.mime.get_charset()
+
+
+class PreparedEmailMessage(EmailMessage):
+    """Письмо рассылки, которое не собирает MIME заново, а берёт готовое из MessageTemplate"""
+
+    def __init__(self, template, email):
+        super().__init__(subject=template.subject, body=template.body, from_email=template.from_email, to=[email])
+        self.template = template
+
+    def message(self):
+        return PreparedMIME(self.template, self.to[0])
+
+
+@lru_cache(maxsize=256)
+def get_message_template(mailing_id, subject, body, from_email):
+    """
+    Собранное письмо рассылки. Кешируется по содержимому,
+    поэтому MIME кодируется один раз на рассылку, пока её текст не изменится
+    """
+    return MessageTemplate(subject, body, from_email)
+
+
+def has_template_tags(text):
+    """Проверяет, есть ли в тексте переменные или теги шаблона Django"""
+    return bool(text) and ('{{' in text or '{%' in text)
+
+
+@lru_cache(maxsize=256)
+def get_body_template(mailing_id, body):
+    """
+    Скомпилированный шаблон текста рассылки для персонализации.
+    Кешируется по тексту, поэтому компилируется один раз на рассылку
+    :return: объект Template или None, если в тексте нет тегов шаблона
+    :raise PersonalizationError: если теги шаблона записаны с ошибкой
+    """
+    if not has_template_tags(body):
+        return None
+    try:
+        return PERSONALIZATION_ENGINE.from_string(body)
+    except TemplateSyntaxError as e:
+        raise PersonalizationError(f'Ошибка в тегах персонализации: {e}') from e
+
+
+def render_body(body_template, client_context):
     """
-    Функция отправки писем каждому получателю в списке
-    :param all_mail: queryset со списком получателей
+    Заполняет текст рассылки данными получателя
+    :raise PersonalizationError: при любой ошибке заполнения шаблона
     """
-    for recipient in all_mail.recipient.all():
-        send_mail(
+    try:
+        return body_template.render(Context({'client': client_context}, autoescape=False))
+    except Exception as e:
+        raise PersonalizationError(f'Ошибка в тегах персонализации: {e}') from e
+
+
+def validate_body(body):
+    """
+    Проверяет текст рассылки: компилирует его и заполняет данными образца получателя,
+    чтобы ошибки, возникающие только при заполнении, обнаруживались до отправки
+    :raise PersonalizationError: если текст нельзя заполнить
+    """
+    body_template = get_body_template(None, body)
+    if body_template is not None:
+        render_body(body_template, SAMPLE_CLIENT_CONTEXT)
+
+
+def get_client_context(client):
+    """Данные получателя, доступные в тексте рассылки как {{ client.name }}, {{ client.email }}, {{ client.comment }}"""
+    return {'name': client.name, 'email': client.email, 'comment': client.comment or ''}
+
+
+def build_message(all_mail, email, client=None):
+    """
+    Функция подготовки письма рассылки одному получателю.
+    Если в тексте рассылки есть теги шаблона, он заполняется данными получателя,
+    иначе используется общее для всех получателей готовое письмо
+    :param all_mail: рассылка
+    :param email: адрес получателя
+    :param client: получатель (Client) для персонализации текста
+    :return: объект EmailMessage
+    :raise PersonalizationError: если текст рассылки нельзя заполнить данными получателя
+    """
+    body_template = get_body_template(all_mail.pk, all_mail.body)
+    if body_template is not None and client is not None:
+        return EmailMessage(
             subject=all_mail.subject,
-            message=all_mail.body,
+            body=render_body(body_template, get_client_context(client)),
             from_email=config.settings.EMAIL_HOST_USER,
-            recipient_list=[recipient]
+            to=[email]
         )
+    template = get_message_template(all_mail.pk, all_mail.subject, all_mail.body, config.settings.EMAIL_HOST_USER)
+    return PreparedEmailMessage(template, email)
+
+
+def iter_chunks(iterable, size):
+    """Делит последовательность (в том числе генератор) на списки по size элементов"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def format_batches_report(batches):
+    """
+    Формирует текст для лога рассылки с временем отправки каждого пакета
+    :param batches: список пар (количество писем, время отправки в секундах)
+    """
+    total = sum(sent for sent, _ in batches)
+    timings = ', '.join(f'{sent} шт. за {elapsed:.2f} с' for sent, elapsed in batches)
+    return f'Отправлено писем: {total}, пакетов: {len(batches)} ({timings})'
+
+
+def delete_in_batches(queryset, batch_size, pause=0):
+    """
+    Удаляет записи queryset пачками по batch_size, чтобы не держать долгие блокировки
+    и не раздувать журнал транзакций БД
+    :param pause: пауза между пачками в секундах
+    :return: количество удалённых записей
+    """
+    deleted = 0
+    while True:
+        pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += queryset.model.objects.filter(pk__in=pks).delete()[0]
+        if pause:
+            time.sleep(pause)
+
+
+def prune_mailing_logs(older_than, batch_size=None, pause=0):
+    """
+    Удаляет логи отправки старше даты older_than пачками по batch_size записей.
+    Старые записи находятся по индексу на дате
+    :param pause: пауза между пачками в секундах
+    :return: количество удалённых записей
+    """
+    old_logs = MailingLog.objects.filter(date__lt=older_than).order_by('date')
+    return delete_in_batches(old_logs, batch_size or config.settings.MAILING_LOG_PRUNE_BATCH_SIZE, pause)
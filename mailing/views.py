@@ -1,12 +1,17 @@
 from datetime import datetime
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin, UserPassesTestMixin
 from django.forms import inlineformset_factory
-from django.http import HttpResponseForbidden
+from django.http import HttpResponseForbidden, HttpResponse, Http404
 from django.urls import reverse_lazy
+from django.views import View
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
 
+from config import settings
+from main.pagination import CursorPaginationMixin
 from mailing.forms import MailingForm, ManagerMailingForm, MailingSettingsForm
+from mailing.metrics import render_prometheus
 from mailing.models import MailingMessage, MailingSettings
+from mailing.stats import get_delivery_report
 
 
 class GetUserForFormMixin:
@@ -18,15 +23,16 @@ class GetUserForFormMixin:
         return kwargs
 
 
-class MailingListView(LoginRequiredMixin, ListView):
-    """Представление для вывода списка всех рассылок"""
+class MailingListView(LoginRequiredMixin, CursorPaginationMixin, ListView):
+    """Представление для вывода списка всех рассылок (курсорная пагинация по id)"""
     paginate_by = 50
     model = MailingMessage
     template_name = 'mailing/mailing_list.html'
     extra_context = {'title': 'Список рассылок'}
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        """Настройки рассылок и авторы загружаются заранее, чтобы число запросов не зависело от размера страницы"""
+        queryset = super().get_queryset().select_related('owner').prefetch_related('settings')
         if self.request.user.has_perm('mailing.view_mailingmessage'):
             return queryset.order_by('pk')
         else:
@@ -42,6 +48,7 @@ class MailingDetailView(LoginRequiredMixin, PermissionRequiredMixin, DetailView)
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['settings'] = MailingSettings.objects.filter(message_id=self.kwargs.get('pk'))
+        context['delivery_report'] = get_delivery_report(self.object.pk)
         return context
 
     def has_permission(self):
@@ -159,3 +166,18 @@ class MailingDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
     def test_func(self):
         obj = self.get_object()
         return self.request.user.is_superuser or obj.owner == self.request.user
+
+
+class MetricsView(View):
+    """
+    Метрики отправки рассылок в текстовом формате Prometheus.
+    Доступны по токену MAILING_METRICS_TOKEN в заголовке Authorization или сотрудникам
+    """
+
+    def get(self, request):
+        if not settings.MAILING_METRICS_ENABLED:
+            raise Http404
+        token = settings.MAILING_METRICS_TOKEN
+        if not (token and request.headers.get('Authorization') == f'Bearer {token}') and not request.user.is_staff:
+            return HttpResponseForbidden()
+        return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
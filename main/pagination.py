@@ -0,0 +1,237 @@
+import base64
+import binascii
+import json
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
+from django.db.models import F, Q
+
+# направление перехода по курсору: следующая или предыдущая страница
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+def encode_cursor(direction, values=None):
+    """Непрозрачный токен курсора: направление и значения ключей сортировки граничной записи"""
+    data = json.dumps({'d': direction, 'v': values}, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """:return: пара (направление, значения) или (None, None) для пустого или повреждённого токена"""
+    if not token:
+        return None, None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        direction, values = data['d'], data['v']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        return None, None
+    if direction not in (NEXT, PREVIOUS) or not (values is None or isinstance(values, list)):
+        return None, None
+    return direction, values
+
+
+def estimate_count(queryset):
+    """
+    Примерное количество записей по статистике планировщика PostgreSQL (без COUNT(*))
+    :return: количество или None для других БД
+    """
+    if connection.vendor != 'postgresql':
+        return None
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class CursorPage:
+    """Страница курсорной пагинации: вместо номера страницы - токены соседних страниц"""
+    is_cursor_page = True
+
+    def __init__(self, object_list, next_cursor, previous_cursor, estimated_count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.last_cursor = encode_cursor(PREVIOUS)
+        self.estimated_count = estimated_count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Курсорная (keyset) пагинация: страница выбирается условием WHERE по ключам сортировки граничной записи
+    вместо OFFSET, поэтому глубокие страницы открываются так же быстро, как первая, и не нужен COUNT(*).
+    Сортировка берётся из queryset (или Meta.ordering модели) и дополняется pk для однозначности;
+    поля сортировки должны быть полями модели, желательно с индексом.
+    Сортировка идёт по значениям столбцов (для внешних ключей - owner_id, а не по сортировке связанной модели),
+    NULL в порядке по возрастанию считается больше любого значения
+    """
+
+    def __init__(self, queryset, per_page, estimate=False):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.estimate = estimate
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        if not {'pk', '-pk', 'id', '-id'} & set(ordering):
+            ordering.append('pk')
+        opts = queryset.model._meta
+        # для внешних ключей сравниваем и сортируем значение столбца (owner_id), а не связанный объект
+        self.model_fields = [opts.pk if name == 'pk' else opts.get_field(name)
+                             for name in (field.lstrip('-') for field in ordering)]
+        self.fields = ['pk' if field.lstrip('-') == 'pk' else model_field.attname
+                       for field, model_field in zip(ordering, self.model_fields)]
+        self.descending = [field.startswith('-') for field in ordering]
+
+    @property
+    def ordering(self):
+        """Сортировка для order_by: по возрастанию NULL в конце, по убыванию - в начале"""
+        ordering = []
+        for name, model_field, descending in zip(self.fields, self.model_fields, self.descending):
+            if model_field.null:
+                ordering.append(F(name).desc(nulls_first=True) if descending else F(name).asc(nulls_last=True))
+            else:
+                ordering.append(f'-{name}' if descending else name)
+        return ordering
+
+    def get_ordered_queryset(self):
+        return self.queryset.order_by(*self.ordering)
+
+    def get_position(self, obj):
+        return [getattr(obj, field) for field in self.fields]
+
+    def clean_values(self, values):
+        """
+        Приводит значения из курсора к типам полей сортировки
+        :return: список значений или None, если курсор подделан или устарел
+        """
+        if not isinstance(values, list) or len(values) != len(self.fields):
+            return None
+        cleaned = []
+        for value, model_field in zip(values, self.model_fields):
+            if value is None:
+                if not model_field.null:
+                    return None
+                cleaned.append(None)
+                continue
+            try:
+                cleaned.append(model_field.to_python(value))
+            except (ValidationError, ValueError, TypeError):
+                return None
+        return cleaned
+
+    @staticmethod
+    def get_equal_filter(name, value):
+        return Q(**{f'{name}__isnull': True}) if value is None else Q(**{name: value})
+
+    @staticmethod
+    def get_after_filter(name, value, greater):
+        """
+        Условие "значение столбца после value" в порядке по возрастанию с NULL в конце (greater)
+        или "до value" (not greater)
+        """
+        if value is None:
+            return Q(pk__in=[]) if greater else Q(**{f'{name}__isnull': False})
+        if greater:
+            return Q(**{f'{name}__gt': value}) | Q(**{f'{name}__isnull': True})
+        return Q(**{f'{name}__lt': value})
+
+    def get_keyset_filter(self, values, direction):
+        """
+        Условие "после граничной записи" в порядке сортировки:
+        (a > x) OR (a = x AND b > y) OR ... для каждого префикса ключей
+        """
+        conditions = []
+        for i, (name, model_field, descending) in enumerate(zip(self.fields, self.model_fields, self.descending)):
+            greater = descending != (direction == NEXT)
+            if model_field.null:
+                after = self.get_after_filter(name, values[i], greater)
+            else:
+                after = Q(**{f'{name}__{"gt" if greater else "lt"}': values[i]})
+            equal = [self.get_equal_filter(self.fields[j], values[j]) for j in range(i)]
+            conditions.append(reduce(lambda left, right: left & right, equal, after))
+        return reduce(lambda left, right: left | right, conditions)
+
+    def get_page(self, cursor=None):
+        direction, values = decode_cursor(cursor)
+        if values is not None:
+            values = self.clean_values(values)
+            if values is None:
+                direction = None
+        queryset = self.get_ordered_queryset()
+        if direction == PREVIOUS:
+            queryset = queryset.reverse()
+        if values is not None:
+            queryset = queryset.filter(self.get_keyset_filter(values, direction))
+
+        objects = list(queryset[:self.per_page + 1])
+        has_more = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        if direction == PREVIOUS:
+            objects.reverse()
+            has_next, has_previous = values is not None, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+
+        next_cursor = previous_cursor = None
+        if objects and has_next:
+            next_cursor = encode_cursor(NEXT, self.get_position(objects[-1]))
+        if objects and has_previous:
+            previous_cursor = encode_cursor(PREVIOUS, self.get_position(objects[0]))
+        estimated_count = estimate_count(self.queryset) if self.estimate else None
+        return CursorPage(objects, next_cursor, previous_cursor, estimated_count)
+
+
+def get_pagination_query(request):
+    """Параметры запроса без параметров пагинации - для ссылок на соседние страницы"""
+    query = request.GET.copy()
+    query.pop('page', None)
+    query.pop('cursor', None)
+    return query.urlencode()
+
+
+def paginate(request, queryset, per_page, estimate=True):
+    """
+    Пагинация для функций-представлений: по номеру страницы, если передан параметр page,
+    иначе по курсору из параметра cursor
+    :return: страница (Page или CursorPage)
+    """
+    paginator = CursorPaginator(queryset, per_page, estimate)
+    if request.GET.get('page'):
+        return Paginator(paginator.get_ordered_queryset(), per_page).get_page(request.GET['page'])
+    return paginator.get_page(request.GET.get('cursor'))
+
+
+class CursorPaginationMixin:
+    """
+    Курсорная пагинация для ListView. Режим по номеру страницы (?page=N, с COUNT(*)) сохранён для старых ссылок.
+    В контекст добавляется pagination_query - остальные параметры запроса для ссылок на страницы
+    """
+    estimate_count = True
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = CursorPaginator(queryset, page_size, self.estimate_count)
+        if self.request.GET.get('page'):
+            # та же сортировка с pk, что и у курсора, чтобы записи с равными ключами не переходили между страницами
+            return super().paginate_queryset(paginator.get_ordered_queryset(), page_size)
+        page = paginator.get_page(self.request.GET.get('cursor'))
+        return None, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['pagination_query'] = get_pagination_query(self.request)
+        return context
@@ -0,0 +1,65 @@
+from django.test import TestCase
+from django.urls import reverse
+
+from main.pagination import CursorPaginator, NEXT, PREVIOUS, encode_cursor
+from mailing.models import MailingMessage
+from users.models import User
+
+
+class CursorPaginatorTestCase(TestCase):
+    """Курсорная пагинация проходит все записи в порядке сортировки, в том числе по полям с NULL"""
+
+    def setUp(self):
+        first = User.objects.create(email='b@test.ru', is_active=True)
+        second = User.objects.create(email='a@test.ru', is_active=True)
+        # Meta.ordering рассылок - ('owner', 'is_published'): владелец может быть не указан
+        for owner in (second, None, first, None, second, first, None):
+            for is_published in (False, True):
+                MailingMessage.objects.create(subject='Тема', body='текст', owner=owner, is_published=is_published)
+
+    def walk(self, paginator, direction):
+        """Проходит все страницы от первой вперёд (NEXT) или от последней назад (PREVIOUS)"""
+        cursor = None if direction == NEXT else encode_cursor(PREVIOUS)
+        pages = []
+        while True:
+            page = paginator.get_page(cursor)
+            pages.append([obj.pk for obj in page])
+            cursor = page.next_cursor if direction == NEXT else page.previous_cursor
+            if cursor is None:
+                break
+        if direction == PREVIOUS:
+            pages.reverse()
+        return [pk for page in pages for pk in page]
+
+    def test_walk_nullable_foreign_key(self):
+        paginator = CursorPaginator(MailingMessage.objects.all(), 3)
+        expected = list(paginator.get_ordered_queryset().values_list('pk', flat=True))
+        # сортировка по столбцу owner_id (NULL в конце), а не по сортировке модели пользователя
+        owners = list(paginator.get_ordered_queryset().values_list('owner_id', flat=True))
+        self.assertEqual(owners, sorted(owners, key=lambda owner_id: (owner_id is None, owner_id)))
+        self.assertEqual(self.walk(paginator, NEXT), expected)
+        self.assertEqual(self.walk(paginator, PREVIOUS), expected)
+
+
+class TamperedCursorTestCase(TestCase):
+    """Подделанный или устаревший курсор открывает первую страницу, а не приводит к ошибке сервера"""
+
+    CURSORS = (
+        'не-base64',
+        encode_cursor(NEXT, [None, 2]),
+        encode_cursor(NEXT, ['x', 'abc']),
+        encode_cursor(PREVIOUS, [[1], {'a': 1}]),
+        encode_cursor(NEXT, [1]),
+        encode_cursor(NEXT, ['x', 'abc', 'y']),
+    )
+
+    def setUp(self):
+        user = User.objects.create(email='admin@test.ru', is_active=True, is_staff=True, is_superuser=True)
+        self.client.force_login(user)
+
+    def test_list_views(self):
+        for name in ('clients:all_clients', 'users:list_users', 'mailing:mailing_list'):
+            for cursor in self.CURSORS:
+                with self.subTest(view=name, cursor=cursor):
+                    response = self.client.get(reverse(name), {'cursor': cursor})
+                    self.assertEqual(response.status_code, 200)
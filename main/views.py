@@ -2,6 +2,7 @@ from django.db.models import Count
 from django.shortcuts import render
 
 from blog.models import Article
+from blog.utils import add_pending_views
 from clients.models import Client
 from mailing.models import MailingSettings
 from main.utils import cache_for_queryset
@@ -10,7 +11,7 @@ from main.utils import cache_for_queryset
 def index(request):
     """Представление для отображения главной страницы"""
     title = 'Главная страница'
-    articles = Article.objects.order_by('?')[:3]
+    articles = add_pending_views(list(Article.objects.order_by('?')[:3]))
     total_mailings = MailingSettings.objects.count()
     total_active_mailings = cache_for_queryset(
         key='total_active_mailings',
@@ -87,3 +87,33 @@ class AdminUserForm(StyleFormMixin, HiddenPasswordMixin, UserChangeForm):
     class Meta:
         model = User
         fields = ('first_name', 'last_name', 'email', 'is_active')
+
+
+class UserFilterForm(StyleFormMixin, forms.Form):
+    """
+    Фильтр списка пользователей по статусу и началу email
+    """
+    STATUS_ACTIVE = 'active'
+    STATUS_BLOCKED = 'blocked'
+
+    status = forms.ChoiceField(required=False, label='Статус',
+                               choices=[('', 'Все'), (STATUS_ACTIVE, 'Активные'), (STATUS_BLOCKED, 'Заблокированные')])
+    email = forms.CharField(required=False, max_length=254, label='Email начинается с')
+
+    def filter(self, queryset):
+        """
+        Фильтрует пользователей по заполненным полям формы
+        :param queryset: пользователи
+        :return: отфильтрованный queryset (без изменений, если форма не заполнена или заполнена с ошибками)
+        """
+        if not self.is_valid():
+            return queryset
+        status = self.cleaned_data['status']
+        if status:
+            queryset = queryset.filter(is_active=status == self.STATUS_ACTIVE)
+        email = self.cleaned_data['email'].strip()
+        if email:
+            # LIKE 'prefix%' с учётом регистра - так PostgreSQL использует индекс users_user_email_243f6e77_like
+            # (varchar_pattern_ops), который Django создаёт для уникального поля email
+            queryset = queryset.filter(email__startswith=email)
+        return queryset
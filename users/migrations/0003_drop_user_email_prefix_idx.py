@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:06
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_list_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_email_prefix_idx',
+        ),
+    ]
@@ -25,6 +25,10 @@ class User(AbstractUser):
         verbose_name = "пользователь"
         verbose_name_plural = "пользователи"
         ordering = ('is_active',)
+        indexes = [
+            # фильтр по статусу и курсорная пагинация списка пользователей по (is_active, email, id)
+            models.Index(fields=['is_active', 'email', 'id'], name='user_active_email_idx'),
+        ]
         permissions = [
             ('can_block_user', 'Может блокировать пользователя'),
         ]
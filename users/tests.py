@@ -0,0 +1,43 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from users.models import User
+
+
+class UsersListTestCase(TestCase):
+    """
+    Страница списка пользователей читает из БД не больше одной страницы записей (LIMIT 51)
+    и выполняет одинаковое количество запросов независимо от количества пользователей
+    """
+
+    def setUp(self):
+        self.admin = User.objects.create(email='admin@test.ru', is_active=True, is_staff=True, is_superuser=True)
+        self.client.force_login(self.admin)
+
+    def create_users(self, count, prefix='user'):
+        User.objects.bulk_create([User(email=f'{prefix}{i:05}@test.ru', is_active=i % 2 == 0) for i in range(count)])
+
+    def get_page(self, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('users:list_users'), params or {})
+        self.assertEqual(response.status_code, 200)
+        page_queries = [query['sql'] for query in queries if 'FROM "users_user"' in query['sql']
+                        and 'LIMIT 51' in query['sql']]
+        self.assertEqual(len(page_queries), 1)
+        self.assertNotIn('password', page_queries[0])
+        self.assertNotIn('COUNT(', ' '.join(query['sql'] for query in queries))
+        self.assertLessEqual(len(response.context['object_list']), 50)
+        return response, len(queries)
+
+    def test_rows_read_do_not_depend_on_table_size(self):
+        self.create_users(60)
+        _, small_count = self.get_page()
+        self.create_users(1000, prefix='more')
+        first, large_count = self.get_page()
+        self.assertEqual(small_count, large_count)
+        # следующая страница по курсору - тот же запрос с условием по ключам сортировки вместо OFFSET
+        response, next_count = self.get_page({'cursor': first.context['page_obj'].next_cursor})
+        self.assertEqual(len(response.context['object_list']), 50)
+        self.assertEqual(next_count, small_count)
@@ -7,7 +7,6 @@ from django.contrib.auth.mixins import PermissionRequiredMixin, LoginRequiredMix
 from django.contrib.auth.views import LoginView, PasswordResetView, PasswordResetConfirmView
 from django.contrib.sites.shortcuts import get_current_site
 from django.core.mail import send_mail
-from django.core.paginator import Paginator
 from django.http import HttpResponseForbidden, HttpResponse, request
 from django.shortcuts import redirect, render
 from django.template.loader import render_to_string
@@ -16,9 +15,13 @@ from django.views import View
 from django.views.generic import CreateView, TemplateView, UpdateView, DeleteView
 
 from users.forms import UserRegisterForm, UserLoginForm, UserForgotPasswordForm, UserSetNewPasswordForm, \
-    UserProfileForm, ModeratorUserForm, AdminUserForm
+    UserProfileForm, ModeratorUserForm, AdminUserForm, UserFilterForm
+from main.pagination import paginate, get_pagination_query
 from users.models import User
 
+# поля пользователя, выводимые в списке пользователей
+USERS_LIST_FIELDS = ('id', 'email', 'first_name', 'last_name', 'is_superuser', 'is_active')
+
 
 class UserLoginView(LoginView):
     """
@@ -199,15 +202,21 @@ class UserUpdateView(PermissionRequiredMixin, UpdateView):
 @login_required
 @permission_required(['users.view_user'])
 def get_users_list(request):
-    users_list = User.objects.all()
-    paginator = Paginator(users_list, 50)
-
-    page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
+    """
+    Список пользователей сервиса с фильтром по статусу и началу email.
+    Загружаются только выводимые в таблице поля и только записи текущей страницы
+    """
+    filter_form = UserFilterForm(request.GET)
+    users_list = (filter_form.filter(User.objects.all())
+                  .only(*USERS_LIST_FIELDS)
+                  .order_by('is_active', 'email'))
+    page_obj = paginate(request, users_list, 50)
     context = {
-        'object_list': users_list,
+        'object_list': page_obj.object_list,
         'title': 'Список пользователей сервиса',
-        "page_obj": page_obj
+        "page_obj": page_obj,
+        'filter_form': filter_form,
+        'pagination_query': get_pagination_query(request),
     }
     return render(request, 'users/users_list.html', context)
 